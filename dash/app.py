@@ -6,11 +6,18 @@ import dash
 import dash_daq as daq
 import dash_core_components as dcc
 import dash_html_components as html
+import plotly
 import plotly.graph_objs as go
+import os
+import threading
+import collections
+import flask
 import boto3
+from botocore.exceptions import ClientError
 from boto3.dynamodb.conditions import Key, Attr
 from dash.dependencies import Input, Output, State
 import logging
+from shared import get_state_store
 
 logger = logging.getLogger()
 logger.addHandler(logging.StreamHandler())
@@ -30,14 +37,112 @@ dynamodb = boto3.resource('dynamodb')
 table = dynamodb.Table(table_name)
 regions_table = dynamodb.Table('regions')
 
-# A list for indicating the Lambda function is running
-running = ['GEOJSON']
+
+class ImageCache:
+    '''
+    A thread-safe LRU cache of the images from S3, limited by total bytes.
+    Each worker has its own cache, the browsers also cache the previews
+    (Cache-Control of serve_preview).
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.images = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.images:
+                self.images.move_to_end(key)
+                return self.images[key]
+        return None
+
+    def put(self, key, image):
+        with self.lock:
+            if key in self.images:
+                return
+            self.images[key] = image
+            self.n_bytes += len(image)
+            while self.n_bytes > self.max_bytes and len(self.images) > 1:
+                _, old = self.images.popitem(last=False)
+                self.n_bytes -= len(old)
+
+
+image_cache = ImageCache(max_bytes=256*1024*1024)
+s3 = boto3.client('s3')
+
+# Number of scenes prefetched by the browser on each side of the hovered
+# scene. The browser keeps them in its cache, whichever worker served them.
+n_prefetch = 3
+
+
+def get_preview_key(key, level):
+    '''
+    Get the S3 key of a preview image, e.g. ndbi/a.png -> ndbi/medium/a.png
+    '''
+    dirname, basename = os.path.split(key)
+    return os.path.join(dirname, level, basename)
+
+
+def get_image(key, level='medium'):
+    '''
+    Get a preview image from the cache or S3. Fall back to the full image
+    for the scenes processed before the previews were saved.
+    '''
+    preview_key = get_preview_key(key, level)
+    image = image_cache.get(preview_key)
+    if image is None:
+        try:
+            image = s3.get_object(Bucket=s3_bucket_name, Key=preview_key)['Body'].read()
+        except ClientError:
+            image = s3.get_object(Bucket=s3_bucket_name, Key=key)['Body'].read()
+        image_cache.put(preview_key, image)
+    return image
+
+
+def get_neighbour_keys(key, curve_number):
+    '''
+    Get the keys of the scenes next to a scene on the time axis from the
+    cached figure of its query, e.g. ndbi/<query_id>_<date_wrs>.png
+    '''
+    query_id = os.path.basename(key).split('_')[0]
+    cached = state.get('figure:' + query_id)
+    if cached is None:
+        return []
+    keys = cached.get("keys", {}).get(str(curve_number), [])
+    if key not in keys:
+        return []
+    index = keys.index(key)
+    return keys[max(0, index-n_prefetch):index] + keys[index+1:index+1+n_prefetch]
+
+
+@server.route('/preview/<level>/<path:key>')
+def serve_preview(level, key):
+    # Only serve the NDBI images of the bucket
+    if level not in ('thumb', 'medium') or not key.startswith('ndbi/'):
+        flask.abort(404)
+    response = flask.Response(get_image(key, level), mimetype='image/png')
+    response.headers['Cache-Control'] = 'public, max-age=86400'
+    return response
+
+
+# State shared by all workers: the regions with a running Lambda function
+# ('running:<geojson_s3_key>'), the first update of the figure
+# ('first_update') and the cached regions and figures
+state = get_state_store()
+state.set('first_update', True)
+
+# Values which never invoke the Lambda function
+no_invoke = ['GEOJSON']
 
 # A list for repeated running
 repeat = ['geojson/enterprise_nw_box.geojson']
 
-# A boolean variable to indicate first update of the figure
-first_update = True
+# Seconds before the shared entries expire
+running_ttl = 15*60
+region_ttl = 5
+figure_ttl_running = 2
+figure_ttl_done = 60*60
 
 # Main layout of the page
 app.layout = html.Div(children=[
@@ -102,29 +207,34 @@ app.layout = html.Div(children=[
         html.Img(id='ndbi-image',
             className='column',
             style={'width': 'auto', 'max-width': 400, 'height': 'auto', 'max-height': 500},
-        )
+        ),
+        # Hidden images of the neighbouring scenes, loaded by the browser
+        html.Div(id='prefetch-images', style={'display': 'none'})
     ]),
 ],
 )
 
 
-@app.callback(Output("ndbi-image", "src"),
+@app.callback([Output("ndbi-image", "src"),
+               Output("prefetch-images", "children")],
              [Input("dev-score-vs-time", "hoverData")],
              [State("ndbi-image", "src"),
               State("summer-only", "on")])
 def update_image_src(hover_data, old_src, summer_only):
     if hover_data:
         if "curveNumber" not in hover_data["points"][0] and summer_only:
-            return old_src
+            return old_src, dash.no_update
         curveNumber = hover_data["points"][0]["curveNumber"]
         if curveNumber == 4 or not summer_only:
             key = hover_data["points"][0]["customdata"]
-            src = "https://{}.s3-us-west-2.amazonaws.com/{}".format(s3_bucket_name,key)
-            return src
+            src = "/preview/medium/{}".format(key)
+            prefetch = [html.Img(src="/preview/medium/{}".format(k))
+                        for k in get_neighbour_keys(key, curveNumber)]
+            return src, prefetch
         else:
-            return old_src
+            return old_src, dash.no_update
     else:
-        return ''
+        return '', []
 
 
 @app.callback([Output("dev-score-vs-time", "figure"),
@@ -157,10 +267,11 @@ def update_figure(n_clicks, n_intervals, value, hoverData):
         )
     }
 
-    region_query = regions_table.query(KeyConditionExpression=Key("geojson_s3_key").eq(value))
+    region = get_region(value)
     # Call the lambda function if the geojson_s3_key is not in the query_info
-    if region_query["ScannedCount"] < 1:
-        if value in running:
+    if region is None:
+        # Only one worker invokes the Lambda function for a region
+        if value in no_invoke or not state.add('running:' + value, True, ttl=running_ttl):
             # Lambda is running. Do not invoke again
             return figure, False, '# of scenes: ', hoverData
         func = boto3.client("lambda")
@@ -170,28 +281,81 @@ def update_figure(n_clicks, n_intervals, value, hoverData):
         response = func.invoke(FunctionName=lambda_function_name,
                                Payload=json.dumps(payload),
                                InvocationType='Event')
-        running.append(value)
 
         logger.info("Response: %s", str(response))
 
         return figure, False, '# of scenes: ', None
+
+    # Figures are cached per query_id for all workers, shortly while the
+    # scenes are being processed. Redraw when more scenes were queued or on
+    # Submit.
+    query_id = region["query_id"]
+    cached = state.get('figure:' + query_id)
+    submitted = any(t['prop_id'] == 'button.n_clicks' for t in dash.callback_context.triggered)
+    if cached is None or submitted or cached.get("n_scenes") != region["number_of_scenes"]:
+        cached = make_figure(query_id, region["number_of_scenes"], figure)
+        ttl = figure_ttl_done if cached["interval_disabled"] else figure_ttl_running
+        state.set('figure:' + query_id, cached, ttl=ttl)
+
+    if cached["n_done"] == 0:
+        return cached["figure"], False, cached["counter_text"], None
+
+    if state.get('first_update') and cached["first_point"] is not None:
+        hover_update = {"points": [cached["first_point"]]}
+        if value in repeat:
+            state.delete('running:' + value)
+
+        state.set('first_update', False)
     else:
+        hover_update = hoverData
+    return cached["figure"], cached["interval_disabled"], cached["counter_text"], hover_update
+
+
+def get_region(value):
+    '''
+    Get the query_id and number_of_scenes of a region from the shared cache
+    or the regions table. Return None if the region is not in the table.
+    '''
+    region = state.get('region:' + value)
+    if region is None:
+        region_query = regions_table.query(KeyConditionExpression=Key("geojson_s3_key").eq(value))
+        if region_query["ScannedCount"] < 1:
+            return None
         region_item = region_query["Items"][0]
-        query_id = region_item["query_id"]
-        n_scenes = region_item["number_of_scenes"]
-
+        region = {"query_id": region_item["query_id"],
+                  "number_of_scenes": int(region_item["number_of_scenes"])}
+        state.set('region:' + value, region, ttl=region_ttl)
+    return region
+
+
+def make_figure(query_id, n_scenes, figure):
+    '''
+    Draw the scores of a query on the figure. Return a JSON-serializable
+    dictionary of the figure, the counter, the first summer point and the
+    image keys of the non-summer (3) and summer (4) curves.
+    '''
     items = table.query(KeyConditionExpression=Key("query_id").eq(query_id))["Items"]
     df = pd.DataFrame(items)
+    # Drop the sampling markers of the years, see sample_more_scenes
+    df = df.dropna(subset=['urban_score'])
 
     n_done = (df['urban_score'] > 0).sum()
+    # Scenes still in the queue or processed scenes which may sample more
+    # scenes, which are not in the counter of the region yet
+    n_queued = 0
+    if 'sampling_status' in df.columns:
+        n_queued = (((df['sampling_status'] == 'queued') & ~(df['urban_score'] > 0))
+                    | (df['sampling_status'] == 'sampling')).sum()
     logger.info('# scenes done/all: %3i/%3i', n_done, n_scenes)
-    interval_disabled = n_done >= n_scenes
+    interval_disabled = n_done >= n_scenes and n_queued == 0
     counter_text = '# of scenes: %3i/%3i' % (n_done, n_scenes)
 
+    first_point = None
+    keys = {}
     if n_done == 0:
         #print('n_done', n_done)
         logger.info('n_done: %i', n_done)
-        return figure, False, counter_text, None
+        interval_disabled = False
     else:
         df_done = df[df['urban_score'] > 0]
         df_done['scene_datetime'] = pd.to_datetime(df_done['scene_datetime'])
@@ -274,27 +438,27 @@ def update_figure(n_clicks, n_intervals, value, hoverData):
                     'line': {'width': 0.5, 'color': 'white'}}
             ),
         ]
-        global first_update
-        if first_update and len(df_done[mask].index)>0:
-            hover_update = {"points":
-                    [{"x": df_done[mask].index[0],
-                      "curveNumber": 4,
-                      "customdata": df_done[mask]['s3_key'].iloc[0]}]}
-            if value in running and value in repeat:
-                running.remove(value)
-
-            first_update = False
-        else:
-            hover_update = hoverData
-    return figure, interval_disabled, counter_text, hover_update
+        keys = {"3": df_done[~mask]['s3_key'].tolist(),
+                "4": df_done[mask]['s3_key'].tolist()}
+        if len(df_done[mask].index)>0:
+            first_point = {"x": str(df_done[mask].index[0]),
+                           "curveNumber": 4,
+                           "customdata": df_done[mask]['s3_key'].iloc[0]}
+    figure = json.loads(json.dumps(figure, cls=plotly.utils.PlotlyJSONEncoder))
+    return {"figure": figure,
+            "interval_disabled": bool(interval_disabled),
+            "counter_text": counter_text,
+            "n_done": int(n_done),
+            "n_scenes": int(n_scenes),
+            "first_point": first_point,
+            "keys": keys}
 
 
 @app.callback(Output("upload", "style"),
              [Input("city-dropdown", "value")],
              [State("upload", "style")])
 def toggle_upload_section(value, style):
-    global first_update
-    first_update = True
+    state.set('first_update', True)
     if value == 'GEOJSON':
         style={
             'width': '100%',
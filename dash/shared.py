@@ -0,0 +1,110 @@
+'''
+State shared by the workers of the dashboard (e.g. under gunicorn).
+
+The values are JSON-serializable and expire after an optional TTL. The
+default store is a SQLite file on the local disk, safe across processes on
+one machine. Set URBAN_GROWTH_REDIS_URL to use a Redis-compatible server
+instead, e.g. for workers on several machines.
+'''
+import os
+import json
+import time
+import sqlite3
+
+
+class SqliteStateStore:
+    '''
+    A key-value store with TTL in a SQLite file.
+    '''
+    def __init__(self, path):
+        self.path = path
+        conn = self.connect()
+        conn.execute('CREATE TABLE IF NOT EXISTS state ('
+                     'key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+        conn.close()
+
+    def connect(self):
+        # Open a connection for every call, connections cannot be shared by
+        # the processes forked by gunicorn
+        return sqlite3.connect(self.path, timeout=10, isolation_level=None)
+
+    def get(self, key):
+        conn = self.connect()
+        try:
+            row = conn.execute('SELECT value FROM state WHERE key = ? '
+                               'AND (expires IS NULL OR expires > ?)',
+                               (key, time.time())).fetchone()
+        finally:
+            conn.close()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        conn = self.connect()
+        try:
+            conn.execute('INSERT OR REPLACE INTO state VALUES (?, ?, ?)',
+                         (key, json.dumps(value), expires))
+            conn.execute('DELETE FROM state WHERE expires < ?', (time.time(),))
+        finally:
+            conn.close()
+
+    def add(self, key, value, ttl=None):
+        '''
+        Set the key only if it is not set. Return True if it was set.
+        '''
+        expires = time.time() + ttl if ttl else None
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM state WHERE key = ? AND expires < ?',
+                         (key, time.time()))
+            cursor = conn.execute('INSERT OR IGNORE INTO state VALUES (?, ?, ?)',
+                                  (key, json.dumps(value), expires))
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        return cursor.rowcount == 1
+
+    def delete(self, key):
+        conn = self.connect()
+        try:
+            conn.execute('DELETE FROM state WHERE key = ?', (key,))
+        finally:
+            conn.close()
+
+
+class RedisStateStore:
+    '''
+    A key-value store with TTL in a Redis-compatible server.
+    '''
+    def __init__(self, url):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self.redis.get(key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.redis.set(key, json.dumps(value), ex=ttl)
+
+    def add(self, key, value, ttl=None):
+        '''
+        Set the key only if it is not set. Return True if it was set.
+        '''
+        return bool(self.redis.set(key, json.dumps(value), ex=ttl, nx=True))
+
+    def delete(self, key):
+        self.redis.delete(key)
+
+
+def get_state_store():
+    '''
+    Get the Redis store if URBAN_GROWTH_REDIS_URL is set, or the SQLite
+    store at URBAN_GROWTH_STATE_PATH.
+    '''
+    redis_url = os.environ.get('URBAN_GROWTH_REDIS_URL')
+    if redis_url:
+        return RedisStateStore(redis_url)
+    path = os.environ.get('URBAN_GROWTH_STATE_PATH', '/tmp/urban-growth-dash.sqlite')
+    return SqliteStateStore(path)
@@ -0,0 +1,262 @@
+'''
+A local catalog of Landsat 8 scenes.
+
+The scenes are kept in columns of numpy arrays (product ID, WRS path and row,
+acquisition date, cloud cover, collection and footprint bounding box) so the
+scenes of a region can be found with in-memory filters instead of a STAC
+search. The columns are compact (about 100 bytes per scene) so a catalog of
+the whole archive fits in the memory of a Lambda function: the product IDs
+are ASCII bytes and the acquisition times are datetime64. A catalog is built from STAC search results or the bulk scene list
+of landsat-pds (s3://landsat-pds/c1/L8/scene_list.gz) and saved as .npz.
+'''
+import csv
+import gzip
+import shutil
+import numpy as np
+from tools import landsat_parse_product_id, get_client, governor
+
+# Lengths of the collection (LC08_L1TP_139045_20170304_20170316_01_T1) and
+# pre-collection (LC81390452017063LGN00) product IDs
+collection_id_length = 40
+precollection_id_length = 21
+
+
+def slice_chars(chars, start, stop):
+    '''
+    Return the substrings [start:stop] of an array of characters (one row
+    per string) as an array of byte strings.
+    '''
+    return np.ascontiguousarray(chars[:, start:stop]).view('S%i' % (stop-start)).ravel()
+
+
+def parse_product_ids(product_ids):
+    '''
+    Parse the path, row, acquisition date and collection of an array of
+    product IDs at once. The IDs not in the collection or pre-collection
+    format are parsed one by one with landsat_parse_product_id.
+    '''
+    product_ids = np.asarray(product_ids, dtype='S%i' % collection_id_length)
+    n = len(product_ids)
+    path = np.zeros(n, dtype=np.int16)
+    row = np.zeros(n, dtype=np.int16)
+    date = np.zeros(n, dtype='datetime64[D]')
+    collection = np.zeros(n, dtype=np.int8)
+    category = np.full(n, b'NA', dtype='S2')
+
+    lengths = np.char.str_len(product_ids)
+    chars = product_ids.view('S1').reshape(n, collection_id_length)
+
+    # LXSS_LLLL_PPPRRR_YYYYMMDD_yyyymmdd_CC_TX
+    c = (lengths == collection_id_length) & (chars[:, 4] == b'_') & (chars[:, 16] == b'_')
+    if c.any():
+        cc = chars[c]
+        path[c] = slice_chars(cc, 10, 13).astype(np.int16)
+        row[c] = slice_chars(cc, 13, 16).astype(np.int16)
+        ymd = np.char.add(np.char.add(slice_chars(cc, 17, 21), b'-'),
+                          np.char.add(np.char.add(slice_chars(cc, 21, 23), b'-'),
+                                      slice_chars(cc, 23, 25)))
+        date[c] = ymd.astype('datetime64[D]')
+        collection[c] = slice_chars(cc, 35, 37).astype(np.int8)
+        category[c] = slice_chars(cc, 38, 40)
+
+    # LXSPPPRRRYYYYDDDGSIVV
+    p = (lengths == precollection_id_length) & ~c
+    if p.any():
+        pc = chars[p]
+        path[p] = slice_chars(pc, 3, 6).astype(np.int16)
+        row[p] = slice_chars(pc, 6, 9).astype(np.int16)
+        year = slice_chars(pc, 9, 13).astype('datetime64[Y]')
+        day = slice_chars(pc, 13, 16).astype(np.int64) - 1
+        date[p] = year.astype('datetime64[D]') + day
+
+    for i in np.nonzero(~(c | p))[0]:
+        meta = landsat_parse_product_id(product_ids[i].decode())
+        path[i], row[i] = int(meta['path']), int(meta['row'])
+        date[i] = np.datetime64(meta['date'])
+
+    return {'product_id': product_ids,
+            'path': path,
+            'row': row,
+            'date': date,
+            'collection': collection,
+            'category': category}
+
+
+def parse_datetimes(datetimes):
+    '''
+    Parse acquisition times, e.g. 2019-08-28T18:57:12.123Z or
+    2019-08-28 18:57:12.123, to datetime64 in seconds. The fractions of
+    seconds and time zones (always UTC) are dropped.
+    '''
+    return np.asarray(datetimes, dtype='U19').astype('datetime64[s]')
+
+
+def get_date_wrs(scene):
+    '''
+    Acquisition date and WRS of a scene as in get_landsat_date_wrs, e.g.
+    20170304_139045
+    '''
+    return '%s_%03i%03i' % (str(scene['date']).replace('-', ''), scene['path'], scene['row'])
+
+
+class SceneCatalog:
+    '''
+    A columnar index of Landsat 8 scenes.
+    '''
+    columns = ('product_id', 'path', 'row', 'date', 'collection',
+               'category', 'datetime', 'cloud_cover', 'bbox')
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data['product_id'])
+
+    def __getitem__(self, column):
+        return self.data[column]
+
+    @classmethod
+    def from_columns(cls, product_ids, datetimes, cloud_cover, bbox):
+        data = parse_product_ids(product_ids)
+        data['datetime'] = parse_datetimes(datetimes)
+        data['cloud_cover'] = np.asarray(cloud_cover, dtype=np.float32)
+        data['bbox'] = np.asarray(bbox, dtype=np.float64).reshape(-1, 4)
+        return cls(data)
+
+    @classmethod
+    def from_items(cls, items):
+        '''
+        Build the catalog from the items of a STAC search (search_scenes).
+        '''
+        product_ids, datetimes, cloud_cover, bbox = [], [], [], []
+        for item in items:
+            product_ids.append(item.properties['landsat:product_id'])
+            datetimes.append(item.properties['datetime'])
+            cloud_cover.append(item.properties['eo:cloud_cover'])
+            bbox.append(item.data.get('bbox', [np.nan]*4))
+        return cls.from_columns(product_ids, datetimes, cloud_cover, bbox)
+
+    @classmethod
+    def from_scene_list(cls, fname):
+        '''
+        Build the catalog from the scene list of landsat-pds (csv or csv.gz).
+        '''
+        open_file = gzip.open if fname.endswith('.gz') else open
+        product_ids, datetimes, cloud_cover, bbox = [], [], [], []
+        with open_file(fname, 'rt') as f:
+            for line in csv.DictReader(f):
+                product_ids.append(line['productId'])
+                datetimes.append(line['acquisitionDate'])
+                cloud_cover.append(line['cloudCover'])
+                bbox.append([line['min_lon'], line['min_lat'],
+                             line['max_lon'], line['max_lat']])
+        return cls.from_columns(product_ids, datetimes, cloud_cover, bbox)
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as f:
+            data = {column: f[column] for column in cls.columns}
+        # Catalogs saved with text columns
+        data['product_id'] = data['product_id'].astype('S%i' % collection_id_length)
+        data['category'] = data['category'].astype('S2')
+        if data['datetime'].dtype.kind == 'U':
+            data['datetime'] = parse_datetimes(data['datetime'])
+        return cls(data)
+
+    def save(self, fname):
+        np.savez_compressed(fname, **self.data)
+
+    def take(self, index):
+        return SceneCatalog({column: values[index] for column, values in self.data.items()})
+
+    def query(self, path=None, row=None, date_range=None, cloud_cover=None,
+              bbox=None, collection=None):
+        '''
+        Return the scenes matching all the given filters:
+            path, row: WRS path and row
+            date_range: (start, end) acquisition dates, inclusive
+            cloud_cover: (min, max) cloud coverage, exclusive as in search_scenes
+            bbox: [min_lon, min_lat, max_lon, max_lat] intersecting the footprint
+            collection: collection number, 0 for pre-collection
+        '''
+        selected = np.ones(len(self), dtype=bool)
+        if path is not None:
+            selected &= self.data['path'] == path
+        if row is not None:
+            selected &= self.data['row'] == row
+        if date_range is not None:
+            selected &= self.data['date'] >= np.datetime64(date_range[0], 'D')
+            selected &= self.data['date'] <= np.datetime64(date_range[1], 'D')
+        if cloud_cover is not None:
+            selected &= self.data['cloud_cover'] > cloud_cover[0]
+            selected &= self.data['cloud_cover'] < cloud_cover[1]
+        if bbox is not None:
+            # Scenes without a footprint are kept
+            footprint = self.data['bbox']
+            selected &= (((footprint[:, 0] <= bbox[2]) & (footprint[:, 2] >= bbox[0])
+                          & (footprint[:, 1] <= bbox[3]) & (footprint[:, 3] >= bbox[1]))
+                         | np.isnan(footprint).any(axis=1))
+        if collection is not None:
+            selected &= self.data['collection'] == collection
+        return self.take(selected)
+
+    def sort(self, column='cloud_cover'):
+        return self.take(np.argsort(self.data[column], kind='stable'))
+
+    def records(self):
+        '''
+        Return the scenes as a list of dictionaries, with the product IDs
+        and categories as strings, the dates and times in ISO format and the
+        date_wrs of the scenes.
+        '''
+        records = []
+        for i in range(len(self)):
+            record = {'product_id': self.data['product_id'][i].decode(),
+                      'path': int(self.data['path'][i]),
+                      'row': int(self.data['row'][i]),
+                      'date': str(self.data['date'][i]),
+                      'collection': int(self.data['collection'][i]),
+                      'category': self.data['category'][i].decode(),
+                      'datetime': str(self.data['datetime'][i]),
+                      'cloud_cover': float(self.data['cloud_cover'][i]),
+                      'bbox': self.data['bbox'][i].tolist()}
+            record['date_wrs'] = get_date_wrs(record)
+            records.append(record)
+        return records
+
+
+def download_file(bucket_name, key, fname):
+    '''
+    Download a file from S3. The request and the reading of the body are
+    retried together by the governor.
+    '''
+    body = get_client('s3').get_object(Bucket=bucket_name, Key=key)['Body']
+    with open(fname, 'wb') as f:
+        shutil.copyfileobj(body, f)
+
+
+# Catalogs loaded in this process, so warm Lambda containers reuse them
+catalogs = {}
+
+def get_catalog(catalog_s3_key, bucket_name='urban-growth'):
+    '''
+    Load a catalog saved on S3, or a local file if the key is a path.
+    '''
+    if catalog_s3_key not in catalogs:
+        fname = catalog_s3_key
+        if not fname.startswith('/'):
+            fname = '/tmp/' + catalog_s3_key.replace('/', '_')
+            governor.call('s3', download_file, bucket_name, catalog_s3_key, fname)
+        catalogs[catalog_s3_key] = SceneCatalog.load(fname)
+    return catalogs[catalog_s3_key]
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Build a scene catalog from a landsat-pds scene list.')
+    parser.add_argument('scene_list', help='scene_list or scene_list.gz of landsat-pds')
+    parser.add_argument('catalog', help='output .npz file')
+    args = parser.parse_args()
+    catalog = SceneCatalog.from_scene_list(args.scene_list)
+    catalog.save(args.catalog)
+    print('Saved %i scenes to %s' % (len(catalog), args.catalog))
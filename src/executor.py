@@ -0,0 +1,411 @@
+'''
+Run the pipeline on a single machine for historical backfills.
+
+get_scenes_send_queues puts the jobs in a local queue instead of SQS and a
+pool of processes runs calc_urban_score on them. The results are written to
+a local store (SQLite or a JSON lines file) instead of DynamoDB and the
+images are copied to a local directory instead of S3.
+'''
+import os
+import json
+import shutil
+import sqlite3
+import fcntl
+import argparse
+import logging
+import collections
+import multiprocessing
+from handler import get_scenes_send_queues, calc_urban_score
+import tools
+from tools import use_local_backend
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Primary keys of the DynamoDB tables
+table_keys = {'urban-development-score': ('query_id', 'scene_date_wrs'),
+              'regions': ('geojson_s3_key',)}
+
+
+class InProcessQueue:
+    '''
+    A queue of jobs in the memory of the current process.
+    '''
+    def __init__(self):
+        self.jobs = collections.deque()
+
+    def put(self, job):
+        self.jobs.append(job)
+
+    def drain(self):
+        jobs = list(self.jobs)
+        self.jobs.clear()
+        return jobs
+
+
+class MultiprocessingQueue:
+    '''
+    A queue of jobs shared by the worker processes.
+    '''
+    def __init__(self):
+        self.jobs = multiprocessing.JoinableQueue()
+
+    def put(self, job):
+        self.jobs.put(job)
+
+    def get(self):
+        return self.jobs.get()
+
+    def task_done(self):
+        self.jobs.task_done()
+
+    def join(self):
+        self.jobs.join()
+
+    def close(self, n_workers):
+        # One sentinel for each worker
+        for i in range(n_workers):
+            self.jobs.put(None)
+
+
+def get_item_key(item, table_name):
+    return json.dumps([item[k] for k in table_keys[table_name]])
+
+
+def update_attributes(item, attr_values):
+    # ':urban_score' -> 'urban_score'
+    for k, v in attr_values.items():
+        item[k[1:]] = v
+    return item
+
+
+def matches_condition(item, condition, unless=None):
+    return (all(item.get(k) == v for k, v in (condition or {}).items())
+            and all(item.get(k) != v for k, v in (unless or {}).items()))
+
+
+def is_lower(item, name, value):
+    return name not in item or float(item[name]['N']) < value
+
+
+def update_number_of_scenes(item, delta):
+    n = int(item['number_of_scenes']['N']) + int(delta)
+    item['number_of_scenes'] = {'N': str(n)}
+    return {'Attributes': {'number_of_scenes': item['number_of_scenes']}}
+
+
+class LocalStore:
+    '''
+    Base class of the local stores. Images are copied to image_dir.
+    '''
+    def __init__(self, path, image_dir='images'):
+        self.path = path
+        self.image_dir = image_dir
+
+    def upload_file(self, fname, key):
+        dest = os.path.join(self.image_dir, key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copyfile(fname, dest)
+        return dest
+
+    def query_items(self, query_id, prefix, table_name):
+        return [item for item in self.items(table_name)
+                if item['query_id']['S'] == str(query_id)
+                and item['scene_date_wrs']['S'].startswith(prefix)]
+
+
+class SqliteStore(LocalStore):
+    '''
+    A SQLite stand-in for the DynamoDB tables. Items are saved as JSON in the
+    same typed format as DynamoDB, e.g. {"urban_score": {"N": "0.95"}}.
+    '''
+    def connect(self):
+        # Open a connection for every call so the store can be shared by
+        # processes
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        conn.execute('CREATE TABLE IF NOT EXISTS items ('
+                     'table_name TEXT, key TEXT, item TEXT, '
+                     'PRIMARY KEY (table_name, key))')
+        return conn
+
+    def get_item(self, conn, key, table_name):
+        row = conn.execute('SELECT item FROM items WHERE table_name = ? AND key = ?',
+                           (table_name, key)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def set_item(self, conn, key, item, table_name):
+        conn.execute('INSERT OR REPLACE INTO items VALUES (?, ?, ?)',
+                     (table_name, key, json.dumps(item)))
+
+    def put_item(self, obj, table_name):
+        conn = self.connect()
+        try:
+            self.set_item(conn, get_item_key(obj, table_name), obj, table_name)
+        finally:
+            conn.close()
+        return {}
+
+    def update_item(self, key, attr_values, table_name, condition=None, unless=None):
+        conn = self.connect()
+        try:
+            # Lock the database for the read-modify-write
+            conn.execute('BEGIN IMMEDIATE')
+            item_key = get_item_key(key, table_name)
+            item = self.get_item(conn, item_key, table_name)
+            if not matches_condition(item, condition, unless):
+                conn.execute('ROLLBACK')
+                return False
+            item.update(key)
+            self.set_item(conn, item_key, update_attributes(item, attr_values), table_name)
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        return {}
+
+    def claim_item(self, key, name, value, table_name):
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            item_key = get_item_key(key, table_name)
+            item = self.get_item(conn, item_key, table_name)
+            if not is_lower(item, name, value):
+                conn.execute('ROLLBACK')
+                return False
+            item.update(key)
+            item[name] = {'N': str(value)}
+            self.set_item(conn, item_key, item, table_name)
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        return {}
+
+    def update_counter(self, geojson_s3_key, delta, table_name):
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            key = {'geojson_s3_key': {'S': geojson_s3_key}}
+            item_key = get_item_key(key, table_name)
+            item = self.get_item(conn, item_key, table_name)
+            response = update_number_of_scenes(item, delta)
+            self.set_item(conn, item_key, item, table_name)
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        return response
+
+    def items(self, table_name='urban-development-score'):
+        conn = self.connect()
+        try:
+            rows = conn.execute('SELECT item FROM items WHERE table_name = ?',
+                                (table_name,)).fetchall()
+        finally:
+            conn.close()
+        return [json.loads(row[0]) for row in rows]
+
+
+class JsonFileStore(LocalStore):
+    '''
+    A JSON lines file stand-in for the DynamoDB tables. Every write is
+    appended to the file and the items are rebuilt by replaying it.
+    '''
+    def append(self, record, check=None):
+        '''
+        Append a record. If check is given, the record is appended only if
+        check(item) of the current item is true.
+        '''
+        with open(self.path, 'a') as f:
+            # Lock the file so lines from processes are not interleaved
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if check:
+                    key = get_item_key(record['key'], record['table_name'])
+                    items = {get_item_key(item, record['table_name']): item
+                             for item in self.items(record['table_name'])}
+                    if not check(items.get(key, {})):
+                        return False
+                f.write(json.dumps(record) + '\n')
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return True
+
+    def put_item(self, obj, table_name):
+        self.append({'op': 'put', 'table_name': table_name, 'item': obj})
+        return {}
+
+    def update_item(self, key, attr_values, table_name, condition=None, unless=None):
+        check = None
+        if condition or unless:
+            check = lambda item: matches_condition(item, condition, unless)
+        if not self.append({'op': 'update', 'table_name': table_name,
+                            'key': key, 'attr_values': attr_values}, check):
+            return False
+        return {}
+
+    def claim_item(self, key, name, value, table_name):
+        if not self.append({'op': 'update', 'table_name': table_name, 'key': key,
+                            'attr_values': {':' + name: {'N': str(value)}}},
+                           lambda item: is_lower(item, name, value)):
+            return False
+        return {}
+
+    def update_counter(self, geojson_s3_key, delta, table_name):
+        self.append({'op': 'counter', 'table_name': table_name, 'delta': delta,
+                     'key': {'geojson_s3_key': {'S': geojson_s3_key}}})
+        return {}
+
+    def items(self, table_name='urban-development-score'):
+        items = collections.OrderedDict()
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, 'r') as f:
+            for line in f:
+                record = json.loads(line)
+                if record['table_name'] != table_name:
+                    continue
+                if record['op'] == 'put':
+                    items[get_item_key(record['item'], table_name)] = record['item']
+                    continue
+                item = items.setdefault(get_item_key(record['key'], table_name),
+                                        dict(record['key']))
+                if record['op'] == 'update':
+                    update_attributes(item, record['attr_values'])
+                else:
+                    update_number_of_scenes(item, record['delta'])
+        return list(items.values())
+
+
+def get_store(path, image_dir='images'):
+    '''
+    Get a SQLite store for .sqlite or .db files, or a JSON lines store.
+    '''
+    if os.path.splitext(path)[1] in ('.sqlite', '.db'):
+        return SqliteStore(path, image_dir)
+    return JsonFileStore(path, image_dir)
+
+
+def sqs_event(job):
+    '''
+    Wrap a job in a SQS event so calc_urban_score reports failed records
+    instead of raising.
+    '''
+    body = dict(job)
+    receive_count = body.pop('_receive_count', 1)
+    return {'Records': [{'messageId': '0',
+                         'body': json.dumps(body),
+                         'attributes': {'ApproximateReceiveCount': str(receive_count)}}]}
+
+
+def run_job(job, queue):
+    '''
+    Run calc_urban_score on a job and put it back to the queue on a
+    transient error.
+    '''
+    response = calc_urban_score(sqs_event(job), None)
+    # The retry policy gives up after max_receive_count
+    if response['batchItemFailures']:
+        logger.info('Retrying job: %s', job)
+        queue.put(dict(job, _receive_count=job.get('_receive_count', 1)+1))
+
+
+def queue_worker(queue, store):
+    '''
+    Process jobs from a MultiprocessingQueue until a sentinel is received.
+    '''
+    use_local_backend(queue, store)
+    while True:
+        job = queue.get()
+        try:
+            if job is None:
+                break
+            run_job(job, queue)
+        except Exception:
+            logger.exception('Failed to process job: %s', job)
+        finally:
+            queue.task_done()
+
+
+def init_pool_worker(store):
+    use_local_backend(InProcessQueue(), store)
+
+
+def pool_job(job):
+    '''
+    Run a job in a pool worker and return the jobs it queued.
+    '''
+    queue = tools.local_backend['queue']
+    try:
+        run_job(job, queue)
+    except Exception:
+        logger.exception('Failed to process job: %s', job)
+    return queue.drain()
+
+
+def run_local(events, queue=None, store=None, processes=None):
+    '''
+    Run get_scenes_send_queues on the events and calc_urban_score on all the
+    queued jobs with a pool of processes. Return the responses of
+    get_scenes_send_queues.
+    '''
+    if queue is None:
+        queue = InProcessQueue()
+    if store is None:
+        store = SqliteStore('urban-growth.sqlite')
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    use_local_backend(queue, store)
+    responses = []
+
+    if isinstance(queue, MultiprocessingQueue):
+        # Workers start processing while the scenes are being queued
+        workers = [multiprocessing.Process(target=queue_worker, args=(queue, store))
+                   for i in range(processes)]
+        for worker in workers:
+            worker.start()
+        for event in events:
+            responses.append(get_scenes_send_queues(event, None))
+        # Wait for all jobs, including the ones queued by the workers
+        queue.join()
+        queue.close(processes)
+        for worker in workers:
+            worker.join()
+    else:
+        for event in events:
+            responses.append(get_scenes_send_queues(event, None))
+        jobs = queue.drain()
+        with multiprocessing.Pool(processes, initializer=init_pool_worker,
+                                  initargs=(store,)) as pool:
+            while jobs:
+                logger.info('Processing %i jobs with %i processes', len(jobs), processes)
+                new_jobs = pool.map(pool_job, jobs, chunksize=1)
+                jobs = [job for queued in new_jobs for job in queued]
+
+    use_local_backend()
+    return responses
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the urban growth pipeline locally.')
+    parser.add_argument('geojson_s3_keys', nargs='+',
+                        help='keys of the geojson files on S3')
+    parser.add_argument('--cloud-cover', nargs=2, type=float, default=[0, 10],
+                        help='min and max cloud coverage')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of processes (default: number of cores)')
+    parser.add_argument('--queue', choices=['memory', 'process'], default='process',
+                        help='in-process queue or multiprocessing work queue')
+    parser.add_argument('--store', default='urban-growth.sqlite',
+                        help='.sqlite/.db for SQLite, otherwise JSON lines file')
+    parser.add_argument('--image-dir', default='images',
+                        help='directory for the NDBI images')
+    args = parser.parse_args()
+
+    queue = MultiprocessingQueue() if args.queue == 'process' else InProcessQueue()
+    store = get_store(args.store, args.image_dir)
+    events = [{'geojson_s3_key': key, 'cloud_cover_range': args.cloud_cover}
+              for key in args.geojson_s3_keys]
+    for response in run_local(events, queue, store, args.processes):
+        print(response['body'])
+
+
+if __name__ == '__main__':
+    main()
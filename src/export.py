@@ -0,0 +1,201 @@
+'''
+Export the urban score histories of regions to Parquet.
+
+The items of each query_id are read from DynamoDB page by page, with only
+the needed attributes, and converted to Arrow record batches. They are
+streamed into a Parquet dataset partitioned by query_id and year, so the
+memory stays bounded whatever the size of the histories. In incremental
+mode only the scenes not exported yet are appended, otherwise the
+partitions of the exported queries are replaced.
+
+    python export.py exports/ --geojson-s3-keys geojson/seattle.geojson
+    python export.py exports/ --query-ids 20191001120000 --incremental
+'''
+import uuid
+import argparse
+import logging
+import pyarrow as pa
+import pyarrow.dataset as ds
+from tools import get_client, governor, governor_limits
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Arrow types of the attributes of the urban-development-score table
+export_schema = pa.schema([
+    ('query_id', pa.string()),
+    ('scene_date_wrs', pa.string()),
+    ('scene_datetime', pa.string()),
+    ('product_id', pa.string()),
+    ('geojson_s3_key', pa.string()),
+    ('urban_score', pa.float64()),
+    ('valid_percent', pa.float64()),
+    ('valid_pixels', pa.int64()),
+    ('total_pixels', pa.int64()),
+    ('cloud_cover', pa.float32()),
+    ('s3_key', pa.string())
+])
+
+# Columns derived from scene_date_wrs, year is also a partition key
+derived_schema = pa.schema([
+    ('date', pa.date32()),
+    ('year', pa.int16())
+])
+
+partitioning = ds.partitioning(pa.schema([('query_id', pa.string()),
+                                          ('year', pa.int16())]), flavor='hive')
+
+default_columns = ['scene_date_wrs', 'scene_datetime', 'product_id',
+                   'urban_score', 'valid_percent', 'cloud_cover']
+
+# Pages read per second, kept low to leave capacity to the pipeline
+governor_limits['dynamodb-export'] = {'min_rate': 1, 'max_rate': 10, 'max_concurrency': 1}
+
+
+def get_query_id(geojson_s3_key, table_name='regions'):
+    '''
+    Get the latest query_id of a region from the regions table.
+    '''
+    db = get_client('dynamodb')
+    response = governor.call('dynamodb-export', db.get_item,
+            TableName=table_name,
+            Key={'geojson_s3_key': {'S': geojson_s3_key}},
+            ProjectionExpression='query_id')
+    if 'Item' not in response:
+        raise KeyError(f'Region {geojson_s3_key} not found')
+    return response['Item']['query_id']['S']
+
+
+def iter_score_pages(query_id, columns, page_size=1000,
+                     table_name='urban-development-score'):
+    '''
+    Yield the pages of the processed scenes (urban_score > 0) of a query,
+    with only the given attributes.
+    '''
+    db = get_client('dynamodb')
+    # Attribute names go through placeholders, some are reserved words
+    names = {f'#c{i}': c for i, c in enumerate(columns)}
+    kwargs = {'TableName': table_name,
+              'KeyConditionExpression': 'query_id = :query_id',
+              'FilterExpression': 'urban_score > :zero',
+              'ProjectionExpression': ','.join(names),
+              'ExpressionAttributeNames': names,
+              'ExpressionAttributeValues': {':query_id': {'S': str(query_id)},
+                                            ':zero': {'N': '0'}},
+              'Limit': page_size}
+    while True:
+        response = governor.call('dynamodb-export', db.query, **kwargs)
+        yield response['Items']
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def decode_value(attr):
+    '''
+    Decode a DynamoDB attribute value, e.g. {"N": "0.95"} -> "0.95"
+    '''
+    if attr is None or 'NULL' in attr:
+        return None
+    if 'N' in attr:
+        return float(attr['N'])
+    return attr['S']
+
+
+def items_to_batch(items, schema):
+    '''
+    Convert DynamoDB items to an Arrow record batch with the schema.
+    '''
+    arrays = []
+    for field in schema:
+        if field.name in derived_schema.names:
+            continue
+        values = [decode_value(item.get(field.name)) for item in items]
+        if pa.types.is_integer(field.type):
+            values = [None if v is None else int(v) for v in values]
+        arrays.append(pa.array(values, type=field.type))
+
+    # e.g. 20190828_047027 -> 2019-08-28, 2019
+    date_wrs = pa.array([item['scene_date_wrs']['S'] for item in items], type=pa.string())
+    dates = pa.array([f'{d[:4]}-{d[4:6]}-{d[6:8]}' for d in date_wrs.to_pylist()]).cast(pa.date32())
+    years = pa.array([int(d[:4]) for d in date_wrs.to_pylist()], type=pa.int16())
+    return pa.RecordBatch.from_arrays(arrays + [dates, years], schema=schema)
+
+
+def get_exported_scenes(base_dir, query_id):
+    '''
+    Get the scene_date_wrs of a query already exported to base_dir.
+    '''
+    try:
+        dataset = ds.dataset(base_dir, format='parquet', partitioning=partitioning)
+    except (FileNotFoundError, ValueError):
+        return set()
+    # An empty directory has no scene_date_wrs column to read
+    if not dataset.files:
+        return set()
+    table = dataset.to_table(columns=['scene_date_wrs'],
+                             filter=ds.field('query_id') == query_id)
+    return set(table.column('scene_date_wrs').to_pylist())
+
+
+def iter_batches(query_ids, schema, base_dir=None, page_size=1000):
+    '''
+    Yield the record batches of the queries. If base_dir is given, skip the
+    scenes already exported there.
+    '''
+    columns = [name for name in schema.names if name not in derived_schema.names]
+    for query_id in query_ids:
+        exported = get_exported_scenes(base_dir, query_id) if base_dir else set()
+        n_rows = 0
+        for items in iter_score_pages(query_id, columns, page_size):
+            items = [item for item in items
+                     if item['scene_date_wrs']['S'] not in exported]
+            if items:
+                n_rows += len(items)
+                yield items_to_batch(items, schema)
+        logger.info('Exported %i new scenes of query %s', n_rows, query_id)
+
+
+def export_scores(base_dir, query_ids, columns=default_columns,
+                  incremental=False, page_size=1000):
+    '''
+    Export the processed scenes of the queries to a Parquet dataset in
+    base_dir, partitioned by query_id and year.
+    '''
+    required = ['query_id', 'scene_date_wrs']
+    fields = [f for f in export_schema if f.name in required or f.name in columns]
+    schema = pa.schema(fields + list(derived_schema))
+
+    batches = iter_batches(query_ids, schema, base_dir if incremental else None, page_size)
+    # Unique file names so incremental runs append to the partitions, a full
+    # run replaces the partitions it writes
+    ds.write_dataset(batches, base_dir, schema=schema, format='parquet',
+                     partitioning=partitioning,
+                     basename_template='part-%s-{i}.parquet' % uuid.uuid4().hex,
+                     existing_data_behavior='overwrite_or_ignore' if incremental
+                                            else 'delete_matching')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export urban score histories to Parquet.')
+    parser.add_argument('base_dir', help='directory of the Parquet dataset')
+    parser.add_argument('--query-ids', nargs='*', default=[],
+                        help='query ids to export')
+    parser.add_argument('--geojson-s3-keys', nargs='*', default=[],
+                        help='regions to export, with their latest query id')
+    parser.add_argument('--columns', nargs='*', default=default_columns,
+                        choices=export_schema.names, help='columns to export')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only append the scenes not exported yet')
+    parser.add_argument('--page-size', type=int, default=1000,
+                        help='items per DynamoDB page')
+    parser.add_argument('--pages-per-second', type=float, default=10,
+                        help='maximum rate of DynamoDB requests')
+    args = parser.parse_args()
+
+    governor_limits['dynamodb-export']['max_rate'] = args.pages_per_second
+    query_ids = args.query_ids + [get_query_id(key) for key in args.geojson_s3_keys]
+    export_scores(args.base_dir, query_ids, args.columns, args.incremental, args.page_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,8 @@ import numpy as np
 import logging
 from datetime import datetime
 from tools import *
+from catalog import SceneCatalog, get_catalog
+from sampling import get_sampling_policy, plan_scenes, needs_more_scenes, is_summer
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
@@ -12,70 +14,252 @@ def calc_urban_score(event, context):
     '''
     An AWS Lambda function that takes a scene and a geojson region and return
     the urban score in that region. This function also saves an image to S3.
+
+    Each record of a SQS or Kinesis batch is processed on its own. Records
+    failing with a permanent error are removed from the region, records
+    failing with a transient error are reported in 'batchItemFailures' so
+    only those are sent back to the queue.
+
+    With adaptive sampling, the next deferred scene of the year is queued
+    after each record while the score of the year is not settled.
     '''
     # Decode from SQS or Kinesis messages
+    raw_records = event['Records'] if 'Records' in event.keys() else [event]
     records = decode_records(event)
 
     outputs = []
-    for record in records:
-        # Parse args from body in record
-        args = parse_args(record)
+    failures = []
+    for raw_record, record in zip(raw_records, records):
+        try:
+            outputs.append(process_record(record))
+        except Exception as exc:
+            receive_count = get_receive_count(raw_record)
+            error_type = classify_error(exc, receive_count)
+            failure = {"item_id": get_record_id(raw_record),
+                       "error": repr(exc),
+                       "error_type": error_type,
+                       "retry": error_type == 'transient'}
+            logger.error('Failed to process record: %s', failure)
+            failures.append(failure)
+
+            if failure['retry'] and failure['item_id'] is None:
+                # Direct invocation: let Lambda retry the whole event
+                raise
+            if failure['retry']:
+                continue
+            try:
+                remove_scene(record)
+            except Exception as cleanup_exc:
+                # Retry the record so the scene is removed on redelivery
+                failure.update({"error": repr(cleanup_exc),
+                                "error_type": 'transient',
+                                "retry": True})
+                logger.error('Failed to remove scene: %s', failure)
+                if failure['item_id'] is None:
+                    raise
+                continue
 
-        query_id = args['query_id']
-        product_id = args['product_id']
+        try:
+            args = parse_args(record)
+            if args.get('sampling'):
+                try:
+                    sample_more_scenes(args)
+                finally:
+                    finish_scene(args)
+        except Exception:
+            # Sampling is best effort, do not process the record again
+            logger.exception('Failed to sample more scenes for %s', record)
+
+    logger.info('Rate governor: %s', governor.stats())
+    logger.info('Landsat I/O: %s', io_stats)
+
+    if 'Records' in event.keys():
+        return prep_batch_response(failures)
+
+    response = prep_response(outputs)
+
+    return response
+
+
+def remove_scene(record):
+    '''
+    Remove a scene which cannot be processed from the number of scenes of
+    the region. The counter is decreased last so a retry of a failed
+    cleanup does not decrease it twice.
+    '''
+    try:
+        args = parse_args(record)
         geojson_s3_key = args['geojson_s3_key']
-        geojson = get_geojson(args)
+    except (ValueError, KeyError):
+        # Malformed message, no region to update
+        return None
 
+    if args.get('sampling'):
         try:
-            # Short-wave Infrared - Band 6
-            image_swir = get_image(product_id, 'B6', geojson)
-            # Near Infrared - Band 5
-            image_nir =  get_image(product_id, 'B5', geojson)
-        except ValueError:
-            # mask region does not overlap with raster image
-            logger.error('Encountered error in %s, removing scenes...', product_id)
-            db_response = decrease_counter(geojson_s3_key)
-            return db_response
+            date_wrs = get_landsat_date_wrs(args['product_id'])
+        except (KeyError, AttributeError):
+            # Malformed or pre-collection product ID, no placeholder to update
+            date_wrs = None
+        if date_wrs is not None:
+            # Claim the cleanup, which also stops the year from waiting for
+            # this scene before sampling more
+            key = {"query_id":       {"S": str(args['query_id'])},
+                   "scene_date_wrs": {"S": date_wrs}}
+            db_response = db_update_item(key, {":sampling_status": {"S": "failed"}},
+                                         unless={"sampling_status": {"S": "failed"}})
+            if db_response is False:
+                logger.info('Scene %s already removed', date_wrs)
+                return None
 
-        # Calculate the Normalized Difference Built-up Index
-        ndbi = (image_swir-image_nir)/(image_swir+image_nir)
+    logger.error('Removing scene from %s...', geojson_s3_key)
+    return decrease_counter(geojson_s3_key)
 
-        valid_pixels = (image_swir>0).sum()
-        total_pixels = (image_swir.data>0).sum()
 
-        # Calculate the urban score
-        urban_score = ndbi.sum() / valid_pixels + 1.0
-        urban_score = np.nan_to_num(urban_score)
+def sample_more_scenes(args):
+    '''
+    Queue the next deferred summer scene of the year of a processed scene if
+    the summer scores of the year are not settled and no scene of the year
+    is waiting in the queue. Return the item of the queued scene or None.
+    '''
+    policy = args['sampling']
+    year = get_landsat_date_wrs(args['product_id'])[:4]
+    items = db_query_items(args['query_id'], year)
 
-        date_wrs = get_landsat_date_wrs(product_id)
+    # Only the summer scenes, as in the plan and the chart, the seasonal
+    # swing of the scores would keep the interval wide
+    scores, deferred = [], []
+    n_finished = 0
+    for item in items:
+        status = item.get('sampling_status', {}).get('S')
+        score = float(item['urban_score']['N'])
+        summer = is_summer(item['scene_date_wrs']['S'], policy)
+        if score > 0 or status == 'failed':
+            n_finished += 1
+        if score > 0:
+            if summer:
+                scores.append(score)
+        elif status == 'queued':
+            # Wait for the scenes in the queue
+            return None
+        elif status == 'deferred' and summer:
+            deferred.append(item)
 
-        key = {"query_id":       {"S": str(query_id)},
-               "scene_date_wrs": {"S": str(date_wrs)}}
+    if not deferred or not needs_more_scenes(scores, policy):
+        return None
 
-        # File name of the image
-        fname = 'ndbi/%s_%s.png' % (query_id, date_wrs)
+    # Scenes finishing together all see the year as settled with nothing in
+    # the queue. They see the same number of finished scenes, so only one
+    # of them claims the year and samples the next scene.
+    key = {"query_id":       {"S": str(args['query_id'])},
+           "scene_date_wrs": {"S": 'sampling_%s' % year}}
+    if db_claim_item(key, 'finished_scenes', n_finished) is False:
+        logger.info('Year %s already sampled after %i scenes', year, n_finished)
+        return None
 
-        # Items to be updated in database
-        attr_values = {":urban_score":  {"N": str(urban_score)},
-                       ":total_pixels": {"N": str(total_pixels)},
-                       ":valid_pixels": {"N": str(valid_pixels)},
-                       ":valid_percent":{"N": str(valid_pixels/total_pixels)},
-                       ":s3_key":       {"S": str(fname)}
-                      }
+    for item in sorted(deferred, key=lambda item: float(item['sampling_rank']['N'])):
+        if queue_deferred_scene(item, args['geojson_s3_key'], policy):
+            logger.info('Sampled %s for %s (%i scores)', item['product_id']['S'], year, len(scores))
+            return item
+    return None
 
-        # Update the database
-        logger.info('Updating DB: (%s, %s)', key, attr_values)
-        db_response = db_update_item(key, attr_values)
-        logger.info('DB response: %s', db_response)
 
-        # Plot the image and save to S3
-        s3_response = plot_save_image_s3(ndbi, fname)
+def finish_scene(args):
+    '''
+    Mark a sampled scene as done once the next scene of its year has been
+    sampled, until then the dashboard keeps polling the query.
+    '''
+    key = {"query_id":       {"S": str(args['query_id'])},
+           "scene_date_wrs": {"S": get_landsat_date_wrs(args['product_id'])}}
+    return db_update_item(key, {":sampling_status": {"S": "done"}},
+                          condition={"sampling_status": {"S": "sampling"}})
 
-        outputs.append(attr_values)
 
-    response = prep_response(outputs)
+def queue_deferred_scene(item, geojson_s3_key, policy):
+    '''
+    Send a deferred scene to SQS and add it to the number of scenes of the
+    region. Return False if the scene has already been queued.
+    '''
+    key = {"query_id":       item["query_id"],
+           "scene_date_wrs": item["scene_date_wrs"]}
+    db_response = db_update_item(key, {":sampling_status": {"S": "queued"}},
+                                 condition={"sampling_status": {"S": "deferred"}})
+    if db_response is False:
+        return False
 
-    return response
+    job = {"query_id": item["query_id"]["S"],
+           "product_id": item["product_id"]["S"],
+           "geojson_s3_key": geojson_s3_key,
+           "sampling": policy
+          }
+    counted = False
+    try:
+        update_counter(geojson_s3_key, 1)
+        counted = True
+        logger.info('Sending message to SQS: %s', str(job))
+        send_queue(job)
+    except Exception:
+        # Give the scene back, otherwise the year waits for it forever
+        if counted:
+            update_counter(geojson_s3_key, -1)
+        db_update_item(key, {":sampling_status": {"S": "deferred"}})
+        raise
+    return True
+
+
+def process_record(record):
+    '''
+    Calculate the urban score of a single record and save the image to S3.
+    '''
+    # Parse args from body in record
+    args = parse_args(record)
+
+    query_id = args['query_id']
+    product_id = args['product_id']
+    geojson = get_geojson(args)
+
+    # Raise ValueError if the mask region does not overlap with raster image
+    # or the scene is too cloudy
+    # Short-wave Infrared - Band 6, Near Infrared - Band 5
+    image_swir, image_nir = get_images(product_id, ['B6', 'B5'], geojson)
+
+    # Calculate the Normalized Difference Built-up Index
+    ndbi = (image_swir-image_nir)/(image_swir+image_nir)
+
+    valid_pixels = (image_swir>0).sum()
+    total_pixels = (image_swir.data>0).sum()
+
+    # Calculate the urban score
+    urban_score = ndbi.sum() / valid_pixels + 1.0
+    urban_score = np.nan_to_num(urban_score)
+
+    date_wrs = get_landsat_date_wrs(product_id)
+
+    key = {"query_id":       {"S": str(query_id)},
+           "scene_date_wrs": {"S": str(date_wrs)}}
+
+    # File name of the image
+    fname = 'ndbi/%s_%s.png' % (query_id, date_wrs)
+
+    # Items to be updated in database
+    attr_values = {":urban_score":  {"N": str(urban_score)},
+                   ":total_pixels": {"N": str(total_pixels)},
+                   ":valid_pixels": {"N": str(valid_pixels)},
+                   ":valid_percent":{"N": str(valid_pixels/total_pixels)},
+                   ":s3_key":       {"S": str(fname)}
+                  }
+
+    # Sampled scenes are done after sampling the next scene, see finish_scene
+    status = {":sampling_status": {"S": "sampling"}} if args.get('sampling') else {}
+
+    # Update the database
+    logger.info('Updating DB: (%s, %s)', key, attr_values)
+    db_response = db_update_item(key, dict(attr_values, **status))
+    logger.info('DB response: %s', db_response)
+
+    # Plot the image and save to S3
+    s3_response = plot_save_image_s3(ndbi, fname)
+
+    return attr_values
 
 
 def get_scenes_send_queues(event, context):
@@ -88,6 +272,10 @@ def get_scenes_send_queues(event, context):
     args is a dictionary containing
         'geojson_s3_key': key (or the path) to geojson file on S3
         'cloud_cover_range': (min, max) cloud coverage
+        'catalog': (optional) key of a scene catalog on S3 to query instead
+                   of the STAC search, see catalog.py
+        'sampling': (optional) 'full' to process all the scenes, or a dict
+                    overriding sampling.sampling_policy
     '''
     args = parse_args(event)
     geojson_s3_key = args['geojson_s3_key']
@@ -98,50 +286,111 @@ def get_scenes_send_queues(event, context):
         cloud_cover_range = args['cloud_cover_range']
     else:
         cloud_cover_range = (0, 10)
-    items = search_scenes(bbox, cloud_cover=cloud_cover_range)
-    logger.info('Found %3i scenes', len(items))
+    if 'catalog' in args.keys():
+        catalog = get_catalog(args['catalog'])
+    else:
+        catalog = SceneCatalog.from_items(search_scenes(bbox, cloud_cover=cloud_cover_range))
+    # Sort the scenes by cloud_cover so the high quality images are processed first
+    scenes = catalog.query(bbox=bbox, cloud_cover=cloud_cover_range).sort('cloud_cover')
+    logger.info('Found %3i scenes', len(scenes))
+
+    # Queue only the best scenes of each year, the others are deferred
+    policy = get_sampling_policy(args)
+    if policy is None:
+        selected, deferred = scenes, scenes.take(slice(0, 0))
+    else:
+        selected_index, deferred_index = plan_scenes(scenes, bbox, policy)
+        selected, deferred = scenes.take(selected_index), scenes.take(deferred_index)
+    logger.info('Queueing %3i scenes, deferring %3i scenes', len(selected), len(deferred))
 
     # Update the regions table
     db_item = {"geojson_s3_key": {"S": str(geojson_s3_key)},
                "query_id": {"S": str(query_id)},
-               "number_of_scenes": {"N": str(len(items))}
+               "number_of_scenes": {"N": str(len(selected))}
               }
     logger.info('Put item in database: %s', str(db_item))
     db_response = db_put_item(db_item, table_name='regions')
     logger.info('db_response: %s', db_response)
 
-    # Sort the items by cloud_cover so the high quality images are processed first
-    for item in sorted(items, key=lambda item: item.properties['eo:cloud_cover']):
-        # Send job to SQS
-        product_id = item.properties["landsat:product_id"]
-        date_wrs = get_landsat_date_wrs(product_id)
-        scene_datetime = item.properties["datetime"]
+    for rank, scene in enumerate(deferred.records()):
+        put_placeholder(query_id, geojson_s3_key, scene, 'deferred', rank)
+
+    for rank, scene in enumerate(selected.records()):
+        # Put the place holder first so the job cannot be overwritten
+        put_placeholder(query_id, geojson_s3_key, scene, 'queued', rank)
 
+        # Send job to SQS
         job = {"query_id": query_id,
-               "product_id": product_id,
+               "product_id": scene["product_id"],
                "geojson_s3_key": geojson_s3_key
               }
+        if policy is not None:
+            job["sampling"] = policy
         logger.info('Sending message to SQS: %s', str(job))
         response = send_queue(job)
 
-        # Put a place holder in database
-        db_item = {"query_id":       {"S": str(query_id)},
-                   "scene_date_wrs": {"S": str(date_wrs)},
-                   "scene_datetime": {"S": str(scene_datetime)},
-                   "product_id":     {"S": str(product_id)},
-                   "urban_score":    {"N": str(0)},
-                   "total_pixels":   {"N": str(0)},
-                   "valid_pixels":   {"N": str(0)},
-                   "valid_percent":  {"N": str(0)},
-                   "geojson_s3_key": {"S": str(geojson_s3_key)},
-                   "s3_key":         {"S": 'na'}
-                  }
-        db_response = db_put_item(db_item)
-
     output = {"query_id": query_id,
               "geojson_s3_key": geojson_s3_key,
               "cloud_cover_range": cloud_cover_range,
-              "number_of_scenes": len(items)
+              "number_of_scenes": len(selected),
+              "number_of_deferred_scenes": len(deferred)
+             }
+    response = prep_response(output)
+
+    return response
+
+
+def put_placeholder(query_id, geojson_s3_key, scene, sampling_status, sampling_rank):
+    '''
+    Put a place holder of a scene in the database.
+    '''
+    db_item = {"query_id":        {"S": str(query_id)},
+               "scene_date_wrs":  {"S": str(scene["date_wrs"])},
+               "scene_datetime":  {"S": str(scene["datetime"])},
+               "product_id":      {"S": str(scene["product_id"])},
+               "urban_score":     {"N": str(0)},
+               "total_pixels":    {"N": str(0)},
+               "valid_pixels":    {"N": str(0)},
+               "valid_percent":   {"N": str(0)},
+               "geojson_s3_key":  {"S": str(geojson_s3_key)},
+               "s3_key":          {"S": 'na'},
+               "cloud_cover":     {"N": str(scene["cloud_cover"])},
+               "sampling_status": {"S": sampling_status},
+               "sampling_rank":   {"N": str(sampling_rank)}
+              }
+    return db_put_item(db_item)
+
+
+def sample_scenes(event, context):
+    '''
+    An AWS Lambda function that queues deferred scenes of a query on demand,
+    best scenes first.
+
+    Input: args or args in the body of event
+    args is a dictionary containing
+        'query_id': query id returned by get_scenes_send_queues
+        'geojson_s3_key': key (or the path) to geojson file on S3
+        'year': (optional) only queue the scenes of this year
+        'number_of_scenes': (optional) number of scenes to queue, default all
+        'sampling': (optional) as in get_scenes_send_queues
+    '''
+    args = parse_args(event)
+    policy = get_sampling_policy(args)
+    items = db_query_items(args['query_id'], str(args.get('year', '')))
+
+    deferred = [item for item in items
+                if item.get('sampling_status', {}).get('S') == 'deferred']
+    deferred = sorted(deferred, key=lambda item: float(item['sampling_rank']['N']))
+    if 'number_of_scenes' in args.keys():
+        deferred = deferred[:int(args['number_of_scenes'])]
+
+    n_queued = 0
+    for item in deferred:
+        n_queued += queue_deferred_scene(item, args['geojson_s3_key'], policy)
+
+    output = {"query_id": args['query_id'],
+              "geojson_s3_key": args['geojson_s3_key'],
+              "number_of_scenes": n_queued
              }
     response = prep_response(output)
 
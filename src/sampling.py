@@ -0,0 +1,100 @@
+'''
+Adaptive sampling of the scenes of a region.
+
+Instead of processing every scene, only the best scenes of each year are
+queued at first: summer acquisitions with a low cloud cover and a footprint
+covering the region. The other scenes are deferred. The deferred summer
+scenes are queued one at a time while the confidence interval of the summer
+urban score of their year is still wider than the target; the non-summer
+scenes are only queued on demand.
+'''
+import numpy as np
+
+# per_year: number of scenes queued for each year at first
+# min_per_year: number of scores needed before the interval is trusted
+# target_ci: half width of the 95% confidence interval of the yearly score
+# months: months of the summer scenes, as in the dashboard
+sampling_policy = {
+    'per_year': 4,
+    'min_per_year': 3,
+    'target_ci': 0.005,
+    'months': [5, 6, 7, 8]
+}
+
+
+def get_sampling_policy(args):
+    '''
+    Get the sampling policy from the args, None to process all the scenes.
+    '''
+    sampling = args.get('sampling', {})
+    if sampling == 'full':
+        return None
+    if not isinstance(sampling, dict):
+        raise ValueError(f"'sampling' must be 'full' or a dict, not {sampling!r}")
+    unknown = set(sampling) - set(sampling_policy)
+    if unknown:
+        raise ValueError(f"Unknown sampling options: {sorted(unknown)}")
+    return dict(sampling_policy, **sampling)
+
+
+def get_coverage(footprints, bbox):
+    '''
+    Fraction of the bbox covered by each footprint [min_lon, min_lat,
+    max_lon, max_lat]. Scenes without a footprint are assumed to cover it.
+    '''
+    width = np.minimum(footprints[:, 2], bbox[2]) - np.maximum(footprints[:, 0], bbox[0])
+    height = np.minimum(footprints[:, 3], bbox[3]) - np.maximum(footprints[:, 1], bbox[1])
+    area = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+    coverage = np.clip(width, 0, None) * np.clip(height, 0, None) / area
+    return np.where(np.isnan(coverage), 1.0, np.clip(coverage, 0, 1))
+
+
+def plan_scenes(catalog, bbox, policy=sampling_policy):
+    '''
+    Split the scenes of a catalog into the ones queued now and the deferred
+    ones. Both are arrays of indices, best scenes first.
+    '''
+    date = catalog['date']
+    year = date.astype('datetime64[Y]').astype(int) + 1970
+    month = date.astype('datetime64[M]').astype(int) % 12 + 1
+    summer = np.isin(month, policy['months'])
+
+    # Lower is better: summer scenes first, then by cloud cover and coverage
+    rank = (~summer) + catalog['cloud_cover'] / 100 + (1 - get_coverage(catalog['bbox'], bbox))
+    order = np.lexsort((rank, year))
+
+    # Position of each scene within its year
+    sorted_year = year[order]
+    first = np.searchsorted(sorted_year, sorted_year, side='left')
+    position = np.arange(len(order)) - first
+
+    selected = order[position < policy['per_year']]
+    deferred = order[position >= policy['per_year']]
+    return selected[np.argsort(rank[selected], kind='stable')], \
+        deferred[np.argsort(rank[deferred], kind='stable')]
+
+
+def is_summer(date_wrs, policy=sampling_policy):
+    '''
+    Check whether a scene_date_wrs (e.g. 20190828_047027) is in the summer
+    months of the policy.
+    '''
+    return int(date_wrs[4:6]) in policy['months']
+
+
+def confidence_half_width(scores):
+    '''
+    Half width of the 95% confidence interval of the mean of the scores.
+    '''
+    if len(scores) < 2:
+        return np.inf
+    return 1.96 * np.std(scores, ddof=1) / np.sqrt(len(scores))
+
+
+def needs_more_scenes(scores, policy=sampling_policy):
+    '''
+    Check whether the summer scores of a year are not settled yet.
+    '''
+    if len(scores) < policy['min_per_year']:
+        return True
+    return confidence_half_width(scores) > policy['target_ci']
@@ -1,4 +1,9 @@
-from handler import get_scenes_send_queues, calc_urban_score
+import json
+from handler import get_scenes_send_queues, calc_urban_score, sample_scenes
+from executor import run_local, InProcessQueue, JsonFileStore
+from catalog import SceneCatalog
+from tools import search_scenes, RateGovernor
+from botocore.exceptions import ClientError
 
 def test_calc_urban_score():
     print('\nTesting calc_urban_score')
@@ -6,14 +11,96 @@ def test_calc_urban_score():
     print(calc_urban_score({"query_id": 0, "product_id": "LC08_L1TP_047027_20190828_20190903_01_T1", "geojson_s3_key": "geojson/seattle.geojson"}, None))
 
 
+def test_calc_urban_score_batch():
+    print('\nTesting calc_urban_score')
+    print('\t- Using a SQS batch with a scene not overlapping the region...')
+    good = {"query_id": 0, "product_id": "LC08_L1TP_047027_20190828_20190903_01_T1", "geojson_s3_key": "geojson/seattle.geojson"}
+    bad = {"query_id": 0, "product_id": "LC08_L1TP_139045_20170304_20170316_01_T1", "geojson_s3_key": "geojson/seattle.geojson"}
+    event = {"Records": [{"messageId": "0", "body": json.dumps(good), "attributes": {"ApproximateReceiveCount": "1"}},
+                         {"messageId": "1", "body": json.dumps(bad), "attributes": {"ApproximateReceiveCount": "1"}}]}
+    print(calc_urban_score(event, None))
+
+
 def test_get_scenes_send_queues():
     print('\nTesting get_scenes_send_queues')
     print(get_scenes_send_queues({"geojson_s3_key": "geojson/seattle.geojson"}, None))
+    print('\t- Processing all the scenes...')
+    print(get_scenes_send_queues({"geojson_s3_key": "geojson/seattle.geojson", "sampling": "full"}, None))
+
+
+def test_sample_scenes():
+    print('\nTesting sample_scenes')
+    response = get_scenes_send_queues({"geojson_s3_key": "geojson/seattle.geojson",
+                                       "sampling": {"per_year": 1}}, None)
+    query_id = json.loads(response['body'])['query_id']
+    print(sample_scenes({"query_id": query_id, "geojson_s3_key": "geojson/seattle.geojson",
+                         "year": 2019, "number_of_scenes": 2}, None))
+
+
+def test_rate_governor():
+    print('\nTesting RateGovernor')
+    limits = {'default': {'min_rate': 1, 'max_rate': 100, 'max_concurrency': 8}}
+    governor = RateGovernor(limits, base_delay=0.001)
+    responses = [ClientError({'Error': {'Code': 'SlowDown'}}, 'PutObject'), 'ok']
+    def func():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+    print('\t- Retrying a throttled call...')
+    assert governor.call('s3', func) == 'ok'
+    stats = governor.stats()['s3']
+    print(stats)
+    # Halved by the throttle, then increased by the success
+    assert stats['rate'] == 51 and stats['concurrency'] == 4
+    assert stats['calls'] == 2 and stats['retries'] == 1 and stats['throttles'] == 1
+
+    print('\t- Not retrying a permanent error...')
+    def denied():
+        raise ClientError({'Error': {'Code': 'AccessDenied'},
+                           'ResponseMetadata': {'HTTPStatusCode': 403}}, 'GetObject')
+    try:
+        governor.call('s3', denied)
+    except ClientError:
+        pass
+    assert governor.stats()['s3']['retries'] == 1
+
+
+def test_scene_catalog():
+    print('\nTesting SceneCatalog')
+    bbox = [-122.44, 47.49, -122.23, 47.74]
+    catalog = SceneCatalog.from_items(search_scenes(bbox, cloud_cover=(0, 10)))
+    catalog.save('/tmp/catalog.npz')
+    catalog = SceneCatalog.load('/tmp/catalog.npz')
+    scenes = catalog.query(path=47, row=27, date_range=('2019-06-01', '2019-08-31'), cloud_cover=(0, 5))
+    print(len(catalog), [scene['product_id'] for scene in scenes.sort().records()])
+
+
+def test_run_local():
+    print('\nTesting run_local')
+    store = JsonFileStore('/tmp/urban-growth.jsonl', image_dir='/tmp/images')
+    print(run_local([{"geojson_s3_key": "geojson/seattle.geojson", "cloud_cover_range": (0, 1)}],
+                    InProcessQueue(), store, processes=2))
+    print(store.items('regions'))
+
+
+def test_export_scores():
+    print('\nTesting export_scores')
+    from export import export_scores, get_query_id
+    query_id = get_query_id('geojson/seattle.geojson')
+    export_scores('/tmp/exports', [query_id], incremental=True)
+    export_scores('/tmp/exports', [query_id], incremental=True)
 
 
 def main():
     test_calc_urban_score()
+    test_calc_urban_score_batch()
     test_get_scenes_send_queues()
+    test_sample_scenes()
+    test_rate_governor()
+    test_scene_catalog()
+    test_run_local()
+    test_export_scores()
 
 
 if __name__ == '__main__':
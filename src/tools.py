@@ -1,5 +1,6 @@
 
 import rasterio
+import rasterio.warp
 import json
 import numpy as np
 import matplotlib.pyplot as plt
@@ -7,9 +8,64 @@ import re
 import os
 import boto3
 import base64
+import tempfile
+from datetime import datetime, timedelta
+import time
+import random
+import threading
+import logging
 from satsearch import Search
-from rasterio.mask import mask
+from botocore.config import Config
+from botocore.exceptions import ClientError, HTTPClientError
+from botocore.exceptions import ConnectionError as BotoConnectionError
+from rasterio.errors import RasterioIOError, WindowError
+from rasterio.features import geometry_mask, geometry_window
+from rasterio.windows import Window
 from l8qa import qa
+logger = logging.getLogger()
+
+# Regular expressions of the Landsat product IDs, compiled once
+product_id_regex = re.compile(
+    r'^(L[COTEM]8\d{6}\d{7}[A-Z]{3}\d{2})|(L[COTEM]08_L\d{1}[A-Z]{2}_\d{6}_\d{8}_\d{8}_\d{2}_(T1|T2|RT))$')
+
+precollection_regex = re.compile(
+    r'^L'
+    r'(?P<sensor>\w{1})'
+    r'(?P<satellite>\w{1})'
+    r'(?P<path>[0-9]{3})'
+    r'(?P<row>[0-9]{3})'
+    r'(?P<acquisitionYear>[0-9]{4})'
+    r'(?P<acquisitionJulianDay>[0-9]{3})'
+    r'(?P<groundStationIdentifier>\w{3})'
+    r'(?P<archiveVersion>[0-9]{2})$', re.IGNORECASE
+)
+
+collection_regex = re.compile(
+    r'^L'
+    r'(?P<sensor>\w{1})'
+    r'(?P<satellite>\w{2})'
+    r'_'
+    r'(?P<processingCorrectionLevel>\w{4})'
+    r'_'
+    r'(?P<path>[0-9]{3})'
+    r'(?P<row>[0-9]{3})'
+    r'_'
+    r'(?P<acquisitionYear>[0-9]{4})'
+    r'(?P<acquisitionMonth>[0-9]{2})'
+    r'(?P<acquisitionDay>[0-9]{2})'
+    r'_'
+    r'(?P<processingYear>[0-9]{4})'
+    r'(?P<processingMonth>[0-9]{2})'
+    r'(?P<processingDay>[0-9]{2})'
+    r'_'
+    r'(?P<collectionNumber>\w{2})'
+    r'_'
+    r'(?P<collectionCategory>\w{2})$', re.IGNORECASE
+)
+
+date_wrs_regex = re.compile(
+    r'L[COTEM]08_L\d{1}[A-Z]{2}_(\d{6})_(\d{8})_\d{8}_\d{2}_(T1|T2|RT)$')
+
 
 def landsat_parse_product_id(product_id):
     '''
@@ -42,47 +98,12 @@ def landsat_parse_product_id(product_id):
 
     '''
 
-    if not re.match('^(L[COTEM]8\d{6}\d{7}[A-Z]{3}\d{2})|(L[COTEM]08_L\d{1}[A-Z]{2}_\d{6}_\d{8}_\d{8}_\d{2}_(T1|T2|RT))$', product_id):
+    if not product_id_regex.match(product_id):
         raise ValueError(f'Could not match {product_id}')
 
-    precollection_pattern = (
-        r'^L'
-        r'(?P<sensor>\w{1})'
-        r'(?P<satellite>\w{1})'
-        r'(?P<path>[0-9]{3})'
-        r'(?P<row>[0-9]{3})'
-        r'(?P<acquisitionYear>[0-9]{4})'
-        r'(?P<acquisitionJulianDay>[0-9]{3})'
-        r'(?P<groundStationIdentifier>\w{3})'
-        r'(?P<archiveVersion>[0-9]{2})$'
-    )
-
-    collection_pattern = (
-        r'^L'
-        r'(?P<sensor>\w{1})'
-        r'(?P<satellite>\w{2})'
-        r'_'
-        r'(?P<processingCorrectionLevel>\w{4})'
-        r'_'
-        r'(?P<path>[0-9]{3})'
-        r'(?P<row>[0-9]{3})'
-        r'_'
-        r'(?P<acquisitionYear>[0-9]{4})'
-        r'(?P<acquisitionMonth>[0-9]{2})'
-        r'(?P<acquisitionDay>[0-9]{2})'
-        r'_'
-        r'(?P<processingYear>[0-9]{4})'
-        r'(?P<processingMonth>[0-9]{2})'
-        r'(?P<processingDay>[0-9]{2})'
-        r'_'
-        r'(?P<collectionNumber>\w{2})'
-        r'_'
-        r'(?P<collectionCategory>\w{2})$'
-    )
-
     meta = None
-    for pattern in [collection_pattern, precollection_pattern]:
-        match = re.match(pattern, product_id, re.IGNORECASE)
+    for regex in [collection_regex, precollection_regex]:
+        match = regex.match(product_id)
         if match:
             meta = match.groupdict()
             break
@@ -91,8 +112,8 @@ def landsat_parse_product_id(product_id):
         raise ValueError(f'Could not match {product_id}')
 
     if meta.get('acquisitionJulianDay'):
-        date = datetime.datetime(int(meta['acquisitionYear']), 1, 1) \
-            + datetime.timedelta(int(meta['acquisitionJulianDay']) - 1)
+        date = datetime(int(meta['acquisitionYear']), 1, 1) \
+            + timedelta(int(meta['acquisitionJulianDay']) - 1)
 
         meta['date'] = date.strftime('%Y-%m-%d')
     else:
@@ -129,8 +150,7 @@ def get_landsat_date_wrs(product_id):
     '''
     Get the acquisition date and wrs from the product id using regex.
     '''
-    pattern = 'L[COTEM]08_L\d{1}[A-Z]{2}_(\d{6})_(\d{8})_\d{8}_\d{2}_(T1|T2|RT)$'
-    wrs, date = re.match(pattern, product_id).groups()[:2]
+    wrs, date = date_wrs_regex.match(product_id).groups()[:2]
     return '%s_%s' % (date, wrs)
 
 
@@ -160,6 +180,235 @@ def decode_records(event):
     return records
 
 
+def get_record_id(record):
+    '''
+    Get the identifier of a SQS or Kinesis record for partial batch responses.
+    '''
+    if 'messageId' in record.keys():
+        return record['messageId']
+    elif 'kinesis' in record.keys():
+        return record['kinesis']['sequenceNumber']
+    else:
+        return None
+
+
+def get_receive_count(record):
+    '''
+    Get the number of times a SQS message has been received.
+    '''
+    attributes = record.get('attributes', {})
+    return int(attributes.get('ApproximateReceiveCount', 1))
+
+
+# Errors in 'permanent' are never retried: the region does not overlap with
+# the scene, the scene is too cloudy or the message is malformed. AWS errors
+# with a code in 'transient_codes' or a 5xx status are sent back to the
+# queue, at most 'max_receive_count' times. 'retry_unknown' decides what to
+# do with others.
+retry_policy = {
+    'permanent': (ValueError, KeyError),
+    'transient_codes': ('Throttling',
+                        'ThrottlingException',
+                        'ProvisionedThroughputExceededException',
+                        'RequestLimitExceeded',
+                        'SlowDown',
+                        'ServiceUnavailable',
+                        'ServiceUnavailableException',
+                        'InternalError',
+                        'InternalServerError',
+                        'RequestTimeout'),
+    'retry_unknown': True,
+    'max_receive_count': 5
+}
+
+
+def classify_error(exc, receive_count=1, policy=retry_policy):
+    '''
+    Classify an exception as 'permanent' or 'transient' with the retry policy.
+    '''
+    if receive_count >= policy['max_receive_count']:
+        return 'permanent'
+    if isinstance(exc, ClientError):
+        code = exc.response.get('Error', {}).get('Code', '')
+        status = exc.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        if code in policy['transient_codes'] or status >= 500:
+            return 'transient'
+        return 'permanent'
+    if isinstance(exc, policy['permanent']):
+        return 'permanent'
+    return 'transient' if policy['retry_unknown'] else 'permanent'
+
+
+def prep_batch_response(failures):
+    '''
+    Report the failed records of a SQS or Kinesis batch so only those are
+    retried (requires ReportBatchItemFailures on the event source mapping).
+    '''
+    return {'batchItemFailures': [{'itemIdentifier': f['item_id']}
+                                  for f in failures
+                                  if f['retry'] and f['item_id'] is not None]}
+
+
+# Error codes and messages of throttled requests. GDAL reports S3 errors of
+# the Landsat reads in the message of RasterioIOError.
+throttle_codes = ('Throttling',
+                  'ThrottlingException',
+                  'ProvisionedThroughputExceededException',
+                  'RequestLimitExceeded',
+                  'SlowDown')
+throttle_messages = ('SlowDown', 'Throttl', '503')
+
+
+def is_throttle_error(exc):
+    if isinstance(exc, ClientError):
+        return exc.response.get('Error', {}).get('Code', '') in throttle_codes
+    if isinstance(exc, RasterioIOError):
+        return any(m in str(exc) for m in throttle_messages)
+    return False
+
+
+def is_retryable_error(exc):
+    # Connection errors and timeouts (EndpointConnectionError,
+    # ConnectionClosedError, ReadTimeoutError, ...) are retried as botocore
+    # would, together with the transient codes and 5xx responses
+    if isinstance(exc, (BotoConnectionError, HTTPClientError)):
+        return True
+    if isinstance(exc, ClientError):
+        code = exc.response.get('Error', {}).get('Code', '')
+        status = exc.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return code in retry_policy['transient_codes'] or status >= 500
+    return is_throttle_error(exc)
+
+
+class RateGovernor:
+    '''
+    Govern the calls to AWS services shared by all callers in the process.
+
+    Each service has a token bucket for the request rate and a concurrency
+    limit. Both are adapted with AIMD: they increase additively on success
+    and are halved when the service throttles. Throttled and transient
+    errors are retried with full jitter exponential backoff.
+    '''
+    def __init__(self, limits, max_retries=6, base_delay=0.05, max_delay=5.0):
+        self.limits = limits
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.condition = threading.Condition()
+        self.services = {}
+
+    def get_state(self, service):
+        if service not in self.services:
+            limit = self.limits.get(service, self.limits['default'])
+            self.services[service] = {'rate': limit['max_rate'],
+                                      'tokens': limit['max_rate'],
+                                      'updated': time.monotonic(),
+                                      'concurrency': limit['max_concurrency'],
+                                      'in_flight': 0,
+                                      'calls': 0,
+                                      'retries': 0,
+                                      'throttles': 0}
+        return self.services[service]
+
+    def acquire(self, service):
+        '''
+        Wait for a concurrency slot and a token of the service.
+        '''
+        with self.condition:
+            state = self.get_state(service)
+            while state['in_flight'] >= int(state['concurrency']):
+                self.condition.wait()
+            state['in_flight'] += 1
+            while True:
+                now = time.monotonic()
+                state['tokens'] = min(state['rate'], state['tokens']
+                                      + (now - state['updated']) * state['rate'])
+                state['updated'] = now
+                if state['tokens'] >= 1:
+                    state['tokens'] -= 1
+                    return
+                self.condition.wait((1 - state['tokens']) / state['rate'])
+
+    def release(self, service, throttled):
+        with self.condition:
+            state = self.get_state(service)
+            limit = self.limits.get(service, self.limits['default'])
+            state['in_flight'] -= 1
+            state['calls'] += 1
+            if throttled:
+                # Multiplicative decrease
+                state['throttles'] += 1
+                state['concurrency'] = max(1, state['concurrency'] / 2)
+                state['rate'] = max(limit['min_rate'], state['rate'] / 2)
+            else:
+                # Additive increase
+                state['concurrency'] = min(limit['max_concurrency'],
+                                           state['concurrency'] + 1 / state['concurrency'])
+                state['rate'] = min(limit['max_rate'], state['rate'] + 1)
+            self.condition.notify_all()
+
+    def call(self, service, func, *args, **kwargs):
+        '''
+        Call func(*args, **kwargs) under the limits of the service.
+        '''
+        for attempt in range(self.max_retries + 1):
+            self.acquire(service)
+            try:
+                response = func(*args, **kwargs)
+            except Exception as exc:
+                self.release(service, is_throttle_error(exc))
+                if attempt == self.max_retries or not is_retryable_error(exc):
+                    raise
+                with self.condition:
+                    self.get_state(service)['retries'] += 1
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+                logger.warning('Retrying %s in %.2f s after %r', service, delay, exc)
+                time.sleep(delay)
+            else:
+                self.release(service, False)
+                return response
+
+    def stats(self):
+        '''
+        Return the current limits and the number of calls, retries and
+        throttles of each service.
+        '''
+        with self.condition:
+            return {service: {'rate': state['rate'],
+                              'concurrency': int(state['concurrency']),
+                              'calls': state['calls'],
+                              'retries': state['retries'],
+                              'throttles': state['throttles']}
+                    for service, state in self.services.items()}
+
+
+# Requests per second and concurrent requests of each service
+governor_limits = {
+    'dynamodb': {'min_rate': 1, 'max_rate': 100, 'max_concurrency': 16},
+    'sqs':      {'min_rate': 1, 'max_rate': 300, 'max_concurrency': 16},
+    's3':       {'min_rate': 1, 'max_rate': 300, 'max_concurrency': 16},
+    'landsat':  {'min_rate': 1, 'max_rate': 100, 'max_concurrency': 8},
+    'default':  {'min_rate': 1, 'max_rate': 50,  'max_concurrency': 8}
+}
+
+governor = RateGovernor(governor_limits)
+
+clients = {}
+
+def get_client(service):
+    '''
+    Get a cached boto3 client. The retries of botocore are turned off so the
+    throttling, connection errors and 5xx responses are retried by the
+    governor, see is_retryable_error.
+    '''
+    # Clients are cached per process, forked processes (e.g. the pool of
+    # executor.py) must not share the connections of their parent
+    key = (os.getpid(), service)
+    if key not in clients:
+        clients[key] = boto3.client(service, config=Config(retries={'max_attempts': 0}))
+    return clients[key]
+
+
 def prep_response(output):
     '''
     Put the output dictionary into the body of an HTTP response.
@@ -240,110 +489,382 @@ def read_geojson_s3(geojson_key, bucket_name='urban-growth'):
     '''
     Read the geojson file on s3 using boto3.
     '''
-    s3 = boto3.client('s3')
-    content_dict = s3.get_object(Bucket=bucket_name, Key=geojson_key)
+    s3 = get_client('s3')
+    content_dict = governor.call('s3', s3.get_object, Bucket=bucket_name, Key=geojson_key)
     file_content = content_dict['Body'].read().decode('utf-8')
     return json.loads(file_content)
 
 
+# GDAL settings for the range requests of the Landsat GeoTIFFs on S3: do not
+# list the directory on open, cache the blocks and merge consecutive ranges.
+landsat_gdal_env = {
+    'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',
+    'CPL_VSIL_CURL_ALLOWED_EXTENSIONS': '.TIF',
+    'VSI_CACHE': True,
+    'VSI_CACHE_SIZE': 50000000,
+    'GDAL_HTTP_MERGE_CONSECUTIVE_RANGES': 'YES',
+    'GDAL_HTTP_MULTIPLEX': 'YES',
+    'GDAL_HTTP_VERSION': 2,
+    'GDAL_CACHEMAX': 256
+}
+
+# Number of reads, internal tiles, range requests and bytes of the Landsat
+# reads in this process
+io_stats = {'reads': 0, 'tiles': 0, 'tiles_skipped': 0, 'requests': 0, 'bytes': 0}
+
+
+def get_region_tiles(shape_mask, window, block_shape):
+    '''
+    Return the (row, col) of the internal tiles with pixels in the region.
+    shape_mask is True outside of the region in the window.
+    '''
+    bh, bw = block_shape
+    row_start, col_start = window.row_off // bh, window.col_off // bw
+    row_stop = (window.row_off + window.height - 1) // bh + 1
+    col_stop = (window.col_off + window.width - 1) // bw + 1
+
+    # Pad the mask to whole tiles and check each tile for region pixels
+    inside = np.zeros(((row_stop-row_start)*bh, (col_stop-col_start)*bw), dtype=bool)
+    r0, c0 = window.row_off - row_start*bh, window.col_off - col_start*bw
+    inside[r0:r0+window.height, c0:c0+window.width] = ~shape_mask
+    inside = inside.reshape(row_stop-row_start, bh, col_stop-col_start, bw).any(axis=(1, 3))
+
+    return [(int(row_start+r), int(col_start+c)) for r, c in zip(*np.nonzero(inside))]
+
+
+def coalesce_tiles(tiles):
+    '''
+    Merge the tiles next to each other in a tile row, which are consecutive
+    in the file, into ranges of (row, col_start, col_stop).
+    '''
+    ranges = []
+    for row, col in sorted(tiles):
+        if ranges and ranges[-1][0] == row and ranges[-1][2] == col:
+            ranges[-1][2] = col + 1
+        else:
+            ranges.append([row, col, col + 1])
+    return [tuple(r) for r in ranges]
+
+
+def get_tiles_bytes(src, tiles):
+    '''
+    Return the compressed size of the tiles, or the uncompressed size if the
+    driver does not report it.
+    '''
+    try:
+        return sum(src.block_size(1, row, col) for row, col in tiles)
+    except Exception:
+        bh, bw = src.block_shapes[0]
+        return len(tiles) * bh * bw * np.dtype(src.dtypes[0]).itemsize
+
+
+def read_region_tiles(src, features):
+    '''
+    Read the pixels of the features (in the CRS of src) from the first band.
+    Only the internal tiles touching the features are read, in block-aligned
+    ranges merged along the tile rows. Pixels outside of the features are
+    set to nodata, as in rasterio.mask.mask with crop=True.
+    Return the image and the I/O profile of the read.
+    '''
+    try:
+        window = geometry_window(src, features).intersection(
+            Window(0, 0, src.width, src.height))
+    except WindowError:
+        raise ValueError('Input shapes do not overlap raster.')
+    window = Window(int(window.col_off), int(window.row_off),
+                    int(window.width), int(window.height))
+
+    shape_mask = geometry_mask(features, (window.height, window.width),
+                               src.window_transform(window))
+    block_shape = src.block_shapes[0]
+    bh, bw = block_shape
+    tiles = get_region_tiles(shape_mask, window, block_shape)
+    ranges = coalesce_tiles(tiles)
+
+    nodata = src.nodata or 0
+    image = np.full((window.height, window.width), nodata, dtype=src.dtypes[0])
+    for row, col_start, col_stop in ranges:
+        tiles_window = Window(col_start*bw, row*bh, (col_stop-col_start)*bw, bh)
+        tiles_window = tiles_window.intersection(window)
+        r0, c0 = tiles_window.row_off - window.row_off, tiles_window.col_off - window.col_off
+        image[r0:r0+tiles_window.height, c0:c0+tiles_window.width] = src.read(1, window=tiles_window)
+    image[shape_mask] = nodata
+
+    n_tiles_window = (((window.row_off + window.height - 1) // bh - window.row_off // bh + 1)
+                      * ((window.col_off + window.width - 1) // bw - window.col_off // bw + 1))
+    profile = {'url': src.name,
+               'window': (window.col_off, window.row_off, window.width, window.height),
+               'tiles': len(tiles),
+               'tiles_skipped': n_tiles_window - len(tiles),
+               'requests': len(ranges),
+               'bytes': get_tiles_bytes(src, tiles)}
+
+    return image, profile
+
+
+def read_masked_image(url, geojson):
+    '''
+    Read the image of the geojson regions from a raster on S3.
+    '''
+    with rasterio.Env(**landsat_gdal_env):
+        with rasterio.open(url) as src:
+            features = [rasterio.warp.transform_geom('EPSG:4326',
+                src.crs, feature["geometry"]) for feature in geojson['features']]
+
+            image, profile = read_region_tiles(src, features)
+
+    logger.info('Read profile: %s', profile)
+    for k in ('tiles', 'tiles_skipped', 'requests', 'bytes'):
+        io_stats[k] += profile[k]
+    io_stats['reads'] += 1
+
+    return image
+
+
+def get_images(product_id, bands, geojson):
+    '''
+    Get the cloud masked images (numpy.ma.MaskedArray) of the geojson
+    regions for a list of bands. The quality band is read only once.
+    '''
+    qa_url = get_landsat_s3_url(product_id, 'BQA')
+
+    # Quality control band for cloud mask
+    qa_image = governor.call('landsat', read_masked_image, qa_url, geojson)
+    cloud_mask = qa.cloud_confidence(qa_image) >= 2
+
+    images = []
+    for band in bands:
+        s3_url = get_landsat_s3_url(product_id, band)
+        image = governor.call('landsat', read_masked_image, s3_url, geojson)
+
+        masked_image = np.ma.masked_array(image, mask=cloud_mask, dtype=np.int16)
+
+        # Raise error if there are less than 80% unmasked pixels or 10,000
+        if (masked_image>0).sum() < max(0.8*(image>0).sum(), 10000):
+            raise ValueError
+
+        images.append(masked_image)
+
+    return images
+
+
 def get_image(product_id, band, geojson):
     '''
     Get the cloud masked image (numpy.ma.MaskedArray) of the geojson
     regions.
     '''
-    s3_url = get_landsat_s3_url(product_id, band)
-    qa_url = get_landsat_s3_url(product_id, 'BQA')
+    return get_images(product_id, [band], geojson)[0]
 
-    # Image of the requested band
-    with rasterio.open(s3_url) as src:
-        features = [rasterio.warp.transform_geom('EPSG:4326',
-            src.crs, feature["geometry"]) for feature in geojson['features']]
 
-        image, transform = mask(src, features, crop=True, indexes=1)
+# Largest dimension in pixels of the preview images. The full image is saved
+# at ndbi/<name>.png and the previews at ndbi/<level>/<name>.png.
+preview_sizes = {'thumb': 128, 'medium': 512}
+
+
+def get_preview_key(fname, level):
+    '''
+    Get the S3 key of a preview image, e.g. ndbi/a.png -> ndbi/medium/a.png
+    '''
+    dirname, basename = os.path.split(fname)
+    return os.path.join(dirname, level, basename)
 
-    # Quality control band for cloud mask
-    with rasterio.open(qa_url) as qa_src:
-        qa_image, transform = mask(qa_src, features, crop=True, indexes=1)
-        cloud_mask = qa.cloud_confidence(qa_image) >= 2
 
-    masked_image = np.ma.masked_array(image, mask=cloud_mask, dtype=np.int16)
+def upload_image(local_fname, fname, bucket_name='urban-growth'):
+    '''
+    Upload an image to S3, or to the local store.
+    '''
+    if local_backend is not None:
+        return local_backend['store'].upload_file(local_fname, fname)
+    # put_object rather than upload_file: S3Transfer wraps the errors in
+    # S3UploadFailedError, which hides the throttling from the governor
+    s3 = get_client('s3')
+    with open(local_fname, 'rb') as f:
+        body = f.read()
+    response = governor.call('s3', s3.put_object, Bucket=bucket_name, Key=fname,
+                             Body=body, ACL='public-read', ContentType='image/png')
+    return response
 
-    # Raise error if there are less than 80% unmasked pixels or 10,000
-    if (masked_image>0).sum() < max(0.8*(image>0).sum(), 10000):
-        raise ValueError
 
-    return masked_image
+def save_previews_s3(image, fname, bucket_name='urban-growth'):
+    '''
+    Save the downsampled preview images, one pixel per image pixel, to S3.
+    '''
+    for level, size in preview_sizes.items():
+        step = max(1, int(np.ceil(max(image.shape) / size)))
+        with tempfile.NamedTemporaryFile(suffix='.png') as tmp:
+            plt.imsave(tmp.name, image[::step, ::step], vmin=-0.2, vmax=0.0,
+                       cmap='PiYG_r', format='png')
+            upload_image(tmp.name, get_preview_key(fname, level), bucket_name)
 
 
 def plot_save_image_s3(image, fname, bucket_name='urban-growth'):
     '''
-    Plot the image and upload the file to S3.
+    Plot the image and upload the file and its previews to S3.
     '''
-    s3 = boto3.client('s3')
-
     # Plot figure
     fig = plt.figure(figsize=(10, 10))
     plt.imshow(image, vmin=-0.2, vmax=0.0, cmap='PiYG_r', interpolation='nearest')
     plt.axis('off')
     plt.tight_layout()
-    plt.savefig('/tmp/tmp.png', bbox_inches='tight', pad_inches=0)
-    response = s3.upload_file('/tmp/tmp.png', bucket_name, fname, ExtraArgs={'ACL':'public-read'})
+    # Use a unique file so concurrent workers do not overwrite each other
+    with tempfile.NamedTemporaryFile(suffix='.png') as tmp:
+        plt.savefig(tmp.name, bbox_inches='tight', pad_inches=0)
+        plt.close(fig)
+        response = upload_image(tmp.name, fname, bucket_name)
+
+    save_previews_s3(image, fname, bucket_name)
 
     return response
 
 
+# Optional local backend replacing SQS, DynamoDB and the image uploads, see
+# executor.py. None means the AWS services are used.
+local_backend = None
+
+def use_local_backend(queue=None, store=None):
+    '''
+    Send jobs to a local queue and write results to a local store instead of
+    SQS and DynamoDB. Call with no arguments to go back to AWS.
+    '''
+    global local_backend
+    if queue is None and store is None:
+        local_backend = None
+    else:
+        local_backend = {'queue': queue, 'store': store}
+
+
 def db_put_item(obj, table_name='urban-development-score'):
     '''
     Put an item in the database.
     '''
-    db = boto3.client('dynamodb')
-    response = db.put_item(
+    if local_backend is not None:
+        return local_backend['store'].put_item(obj, table_name)
+    db = get_client('dynamodb')
+    response = governor.call('dynamodb', db.put_item,
             TableName=table_name,
             Item=obj)
 
     return response
 
 
-def db_update_item(key, attr_values, table_name='urban-development-score'):
+def db_update_item(key, attr_values, table_name='urban-development-score',
+                   condition=None, unless=None):
     '''
-    Update the itme in the database.
+    Update the itme in the database. If condition is given, e.g.
+    {"sampling_status": {"S": "deferred"}}, the item is updated only if its
+    attributes are equal to the values, and False is returned otherwise.
+    unless is the opposite, the item is updated only if its attributes are
+    not equal to the values (or missing).
     '''
-    db = boto3.client('dynamodb')
+    if local_backend is not None:
+        return local_backend['store'].update_item(key, attr_values, table_name, condition, unless)
+    db = get_client('dynamodb')
     update_expression = 'SET {}'.format(','.join(f'{k[1:]} = {k}' for k in attr_values))
-    response = db.update_item(
-            TableName=table_name,
-            Key=key,
-            UpdateExpression=update_expression,
-            ExpressionAttributeValues=attr_values
-    )
+    kwargs = {}
+    expressions = [f'{k} = :cond_{k}' for k in condition or {}]
+    expressions += [f'(attribute_not_exists({k}) OR {k} <> :unless_{k})' for k in unless or {}]
+    if expressions:
+        kwargs['ConditionExpression'] = ' AND '.join(expressions)
+        attr_values = dict(attr_values, **{f':cond_{k}': v for k, v in (condition or {}).items()},
+                           **{f':unless_{k}': v for k, v in (unless or {}).items()})
+    try:
+        response = governor.call('dynamodb', db.update_item,
+                TableName=table_name,
+                Key=key,
+                UpdateExpression=update_expression,
+                ExpressionAttributeValues=attr_values,
+                **kwargs
+        )
+    except ClientError as exc:
+        if exc.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+            return False
+        raise
+    return response
 
 
-def decrease_counter(geojson_s3_key, table_name='regions'):
+def db_claim_item(key, name, value, table_name='urban-development-score'):
     '''
-    Decrease the number of scenes.
+    Set the number attribute name of an item to value if it is missing or
+    lower, e.g. to claim a step of a job only once. Return False otherwise.
+    '''
+    if local_backend is not None:
+        return local_backend['store'].claim_item(key, name, value, table_name)
+    db = get_client('dynamodb')
+    try:
+        response = governor.call('dynamodb', db.update_item,
+                TableName=table_name,
+                Key=key,
+                UpdateExpression=f'SET {name} = :value',
+                ConditionExpression=f'attribute_not_exists({name}) OR {name} < :value',
+                ExpressionAttributeValues={':value': {'N': str(value)}}
+        )
+    except ClientError as exc:
+        if exc.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+            return False
+        raise
+    return response
+
+
+def db_query_items(query_id, prefix='', table_name='urban-development-score'):
+    '''
+    Get all the items of a query with scene_date_wrs starting with prefix,
+    e.g. the year. The read is strongly consistent, the sampling decisions
+    depend on the latest status of the scenes.
+    '''
+    if local_backend is not None:
+        return local_backend['store'].query_items(query_id, prefix, table_name)
+    db = get_client('dynamodb')
+    kwargs = {'TableName': table_name,
+              'KeyConditionExpression': 'query_id = :query_id AND begins_with(scene_date_wrs, :prefix)',
+              'ConsistentRead': True,
+              'ExpressionAttributeValues': {':query_id': {'S': str(query_id)},
+                                            ':prefix': {'S': str(prefix)}}}
+    items = []
+    while True:
+        response = governor.call('dynamodb', db.query, **kwargs)
+        items.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            return items
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def update_counter(geojson_s3_key, delta, table_name='regions'):
+    '''
+    Add delta to the number of scenes.
     '''
-    db = boto3.client('dynamodb')
-    response = db.update_item(
+    if local_backend is not None:
+        return local_backend['store'].update_counter(geojson_s3_key, delta, table_name)
+    db = get_client('dynamodb')
+    response = governor.call('dynamodb', db.update_item,
             TableName=table_name,
             Key={
                 'geojson_s3_key': {'S': geojson_s3_key}
             },
-            UpdateExpression="set number_of_scenes = number_of_scenes - :val",
+            UpdateExpression="set number_of_scenes = number_of_scenes + :val",
             ExpressionAttributeValues={
-                ':val': {'N': '1'}
+                ':val': {'N': str(delta)}
             },
             ReturnValues="UPDATED_NEW"
     )
     return response
 
 
+def decrease_counter(geojson_s3_key, table_name='regions'):
+    '''
+    Decrease the number of scenes.
+    '''
+    return update_counter(geojson_s3_key, -1, table_name)
+
+
 sqs_url = 'https://us-west-2.queue.amazonaws.com/940900654266/landsat-scenes'
 
 def send_queue(job, queue_url=sqs_url):
     '''
     Send the job to SQS queue.
     '''
-    sqs = boto3.client('sqs')
-    response = sqs.send_message(QueueUrl=queue_url, MessageBody=json.dumps(job))
+    if local_backend is not None:
+        return local_backend['queue'].put(job)
+    sqs = get_client('sqs')
+    response = governor.call('sqs', sqs.send_message, QueueUrl=queue_url, MessageBody=json.dumps(job))
 
     return response